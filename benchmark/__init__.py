@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+
+'''
+Benchmark suite of dbarchive against a local mongodb stand-in.
+
+Run it from the repository root, e.g.
+
+    python -m benchmark --backend mongod --output result.json
+'''
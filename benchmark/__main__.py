@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Run the benchmark cases and write the results in JSON.
+
+Each case is run in its own child process, so that its peak memory is measured separately.
+'''
+
+import sys
+import json
+import platform
+import resource
+import argparse
+import itertools
+import subprocess
+import traceback
+import multiprocessing
+from datetime import datetime
+
+from dbarchive import instrumentation
+from benchmark.backend import backends
+from benchmark.cases import cases
+
+units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+def parse_size(text):
+    '''
+    returns the bytes of the size such as 512, 64K, 16M or 1G.
+    '''
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_list(text, parse=str):
+    return [parse(item) for item in text.split(',') if item.strip()]
+
+
+def peak_memory():
+    '''
+    returns the peak resident set size of the process in bytes.
+    '''
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OSX, and in kilobytes on linux.
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        'times': times,
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times)
+    }
+
+
+def run_case(name, params, instrument, queue):
+    '''
+    run the case in the child process and put its result into the queue.
+    '''
+    try:
+        if instrument:
+            instrumentation.enable()
+        result = cases[name](**params)
+        for operation, times in result.pop('timings').items():
+            result[operation] = summarize(times)
+            nbytes = result.get('bytes')
+            if nbytes:
+                result[operation]['throughput'] = nbytes / result[operation]['median']
+        result['peak_memory'] = peak_memory()
+        if instrument:
+            result['instrumentation'] = instrumentation.snapshot()
+        queue.put(result)
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+
+def run(name, params, instrument):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_case, args=(name, params, instrument, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    result.update({'case': name, 'params': params})
+    return result
+
+
+def variations(args):
+    '''
+    yields the (case name, params) to be measured.
+    '''
+    if 'save_load' in args.cases:
+        for attributes, size, dtype, archiver in itertools.product(
+                args.attributes, args.sizes, args.dtypes, args.archivers):
+            yield 'save_load', {
+                'attributes': attributes, 'size': size, 'dtype': dtype,
+                'archiver': archiver, 'repeat': args.repeat
+            }
+    if 'scan' in args.cases:
+        for documents in args.documents:
+            yield 'scan', {'documents': documents, 'repeat': args.repeat}
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark dbarchive against a local mongodb stand-in')
+    parser.add_argument('--backend', choices=sorted(backends), default='mongod')
+    parser.add_argument('--uri', help='the mongodb uri for the uri backend')
+    parser.add_argument('--mongod', default='mongod', help='the mongod executable for the mongod backend')
+    parser.add_argument('--cases', type=parse_list, default=sorted(cases))
+    parser.add_argument('--attributes', type=lambda text: parse_list(text, int), default=[1, 10])
+    parser.add_argument('--sizes', type=lambda text: parse_list(text, parse_size), default=[1 << 10, 1 << 20, 64 << 20])
+    parser.add_argument('--dtypes', type=parse_list, default=['float64', 'int32', 'uint8'])
+    parser.add_argument('--archivers', type=parse_list, default=['npy', 'pickle'])
+    parser.add_argument('--documents', type=lambda text: parse_list(text, int), default=[1000, 10000])
+    parser.add_argument('--full', action='store_true',
+                        help='measure up to 1G arrays and 10^6 documents')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--instrument', action='store_true', help='include the instrumentation stats')
+    parser.add_argument('--output', help='the JSON file to write (stdout by default)')
+    args = parser.parse_args()
+    if args.full:
+        args.sizes = [1 << 10, 1 << 20, 64 << 20, 1 << 30]
+        args.documents = [1000, 10000, 100000, 1000000]
+
+    if args.backend == 'uri':
+        backend = backends['uri'](args.uri)
+    elif args.backend == 'mongod':
+        backend = backends['mongod'](executable=args.mongod)
+    else:
+        backend = backends[args.backend]()
+
+    report = {
+        'revision': revision(),
+        'started': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'backend': backend.name,
+        'results': []
+    }
+    with backend:
+        for name, params in variations(args):
+            sys.stderr.write('{} {}\n'.format(name, json.dumps(params, sort_keys=True)))
+            report['results'].append(run(name, params, args.instrument))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Backend module for the local mongodb stand-ins used by the benchmark
+'''
+
+import os
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+
+import pymongo
+from dbarchive import connect
+
+
+def free_port():
+    '''
+    returns the port number not used on the local host.
+    '''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Backend(object):
+    '''
+    the superclass of the benchmark backends.
+
+    start() prepares the mongodb and returns the keyword arguments of dbarchive.connect.
+    '''
+    name = None
+
+    def start(self):
+        raise NotImplementedError()
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        connect(self.database, **self.start())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+class MongodBackend(Backend):
+    '''
+    The backend spawning a mongod process on a temporary directory and a free port.
+    '''
+    name = 'mongod'
+
+    def __init__(self, database='__py_dbarchive_benchmark', executable='mongod', timeout=30):
+        self.database = database
+        self.executable = executable
+        self.timeout = timeout
+        self.process = None
+        self.directory = None
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix='dbarchive_benchmark_')
+        port = free_port()
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen([
+                self.executable, '--dbpath', self.directory, '--port', str(port),
+                '--bind_ip', '127.0.0.1', '--nounixsocket'
+            ], stdout=devnull, stderr=devnull)
+        self.wait(port)
+        return {'host': '127.0.0.1', 'port': port}
+
+    def wait(self, port):
+        '''
+        wait until the mongod accepts the connections.
+        '''
+        deadline = time.time() + self.timeout
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError('mongod exited with {}'.format(self.process.returncode))
+            client = pymongo.MongoClient('127.0.0.1', port, serverSelectionTimeoutMS=500)
+            try:
+                client.admin.command('ping')
+                return
+            except pymongo.errors.PyMongoError:
+                if time.time() > deadline:
+                    raise RuntimeError('mongod did not start in {} sec'.format(self.timeout))
+            finally:
+                client.close()
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class MongomockBackend(Backend):
+    '''
+    The backend with the in-memory mongomock, which is not representative for the I/O
+    but requires no mongod.
+    '''
+    name = 'mongomock'
+
+    def __init__(self, database='__py_dbarchive_benchmark'):
+        self.database = database
+
+    def start(self):
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+        return {'host': 'mongomock://localhost'}
+
+
+class UriBackend(Backend):
+    '''
+    The backend connecting the mongodb already running at the uri.
+    '''
+    name = 'uri'
+
+    def __init__(self, uri, database='__py_dbarchive_benchmark'):
+        self.uri = uri
+        self.database = database
+
+    def start(self):
+        return {'host': self.uri}
+
+
+backends = {
+    'mongod': MongodBackend,
+    'mongomock': MongomockBackend,
+    'uri': UriBackend
+}
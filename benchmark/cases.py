@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Cases module for the benchmark cases measured in the child processes
+'''
+
+import numpy
+from timeit import default_timer
+
+from dbarchive import Base
+from dbarchive.base import PickleArchiver
+
+
+def define_class(name):
+    '''
+    returns a new Base class to be stored into its own collection.
+    '''
+    return type(name, (Base, ), {})
+
+
+def make_array(size, dtype):
+    '''
+    returns the random array of about size bytes.
+    '''
+    dtype = numpy.dtype(dtype)
+    count = max(1, size // dtype.itemsize)
+    if dtype.kind == 'f':
+        return numpy.random.rand(count).astype(dtype)
+    return numpy.random.randint(0, 100, count).astype(dtype)
+
+
+def timed(func):
+    '''
+    returns the tuple of the elapsed seconds and the result of func.
+    '''
+    start = default_timer()
+    result = func()
+    return default_timer() - start, result
+
+
+def save_load(attributes=1, size=1 << 20, dtype='float64', archiver='npy', repeat=3):
+    '''
+    measure the insert, the update and the load of an instance
+    with attributes arrays of size bytes each.
+    '''
+    clazz = define_class('BenchSaveLoad')
+    clazz.drop_collection()
+    timings = {'insert': [], 'update': [], 'load': []}
+    total = 0
+    for _ in range(repeat):
+        instance = clazz()
+        if archiver == 'pickle':
+            instance.archivers[numpy.ndarray] = PickleArchiver()
+        for i in range(attributes):
+            setattr(instance, 'a{}'.format(i), make_array(size, dtype))
+        total = sum(getattr(instance, 'a{}'.format(i)).nbytes for i in range(attributes))
+
+        elapsed, _ = timed(instance.save)
+        timings['insert'].append(elapsed)
+
+        for i in range(attributes):
+            getattr(instance, 'a{}'.format(i))[0] += 1
+        elapsed, _ = timed(instance.save)
+        timings['update'].append(elapsed)
+
+        pk = instance.collection.pk
+        # the saved instance is released before the load
+        instance = None
+        elapsed, _ = timed(lambda: clazz.objects(pk=pk).get().prefetch())
+        timings['load'].append(elapsed)
+    clazz.drop_collection()
+    return {'bytes': total, 'timings': timings}
+
+
+def scan(documents=1000, size=1 << 10, batch_size=1000, repeat=3):
+    '''
+    measure the cursor scans over documents instances with a small array each,
+    with and without restoring the arrays.
+    '''
+    clazz = define_class('BenchScan')
+    clazz.drop_collection()
+    instances = []
+    for i in range(documents):
+        instance = clazz()
+        instance.index = i
+        instance.array = make_array(size, 'float64')
+        instances.append(instance)
+    elapsed, _ = timed(lambda: clazz.save_many(instances, batch_size=batch_size))
+    instances = None
+
+    def iterate(restore):
+        def run():
+            for instance in clazz.objects.stream(batch_size=batch_size):
+                if restore:
+                    instance.array
+        return run
+
+    timings = {'save_many': [elapsed], 'scan': [], 'scan_restore': [], 'scan_native': []}
+    for _ in range(repeat):
+        timings['scan'].append(timed(iterate(False))[0])
+        timings['scan_restore'].append(timed(iterate(True))[0])
+        timings['scan_native'].append(timed(lambda: sum(1 for _ in clazz.native_objects.all()))[0])
+    clazz.drop_collection()
+    return {'documents': documents, 'timings': timings}
+
+
+cases = {
+    'save_load': save_load,
+    'scan': scan
+}
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+'''
+Check the round trips of the instances through LocalStorage, which requires no mongodb.
+'''
+
+import shutil
+import tempfile
+import numpy
+from dbarchive import Base
+from dbarchive import LocalStorage
+
+
+def check_round_trip(Sample):
+    sample = Sample()
+    sample.name = 'a'
+    sample.count = 1
+    sample.data = numpy.arange(10)
+    sample.weights = numpy.random.rand(3, 4)
+    assert sample.save() == ['count', 'data', 'name', 'weights']
+
+    loaded = Sample.objects(pk=sample.collection.pk).get()
+    assert loaded.name == 'a' and loaded.count == 1
+    assert numpy.array_equal(loaded.data, sample.data)
+    assert numpy.array_equal(loaded.weights, sample.weights)
+    assert Sample.objects(pk=str(sample.collection.pk)).count() == 1
+    assert Sample.objects(pk__in=[str(sample.collection.pk)]).count() == 1
+    assert Sample.load(str(sample.collection.pk)).name == 'a'
+    assert Sample.objects(name='a').count() == 1
+    assert Sample.objects(count__gt=1).first() is None
+
+
+def check_lazy_binaries_kept(Sample):
+    '''
+    the binaries not accessed are kept on saving the other attributes.
+    '''
+    sample = Sample()
+    sample.name = 'b'
+    sample.data = numpy.arange(5)
+    sample.save()
+
+    loaded = Sample.objects(pk=sample.collection.pk).get()
+    loaded.name = 'c'
+    assert loaded.save() == ['name']
+    loaded = Sample.objects(pk=sample.collection.pk).get()
+    assert loaded.name == 'c'
+    assert numpy.array_equal(loaded.data, sample.data)
+
+
+def check_removed_binary(Sample):
+    '''
+    the binary replaced by a native is deleted.
+    '''
+    sample = Sample()
+    sample.data = numpy.arange(5)
+    sample.save()
+    sample.data = 'replaced'
+    sample.save()
+    loaded = Sample.objects(pk=sample.collection.pk).get()
+    assert loaded.data == 'replaced'
+
+
+def check_projected_save(Sample):
+    '''
+    the natives not loaded by only() are kept on saving.
+    '''
+    sample = Sample()
+    sample.name = 'd'
+    sample.count = 2
+    sample.save()
+
+    loaded = Sample.objects.only('count').get(pk=sample.collection.pk)
+    loaded.count = 3
+    loaded.save()
+    loaded = Sample.objects(pk=sample.collection.pk).get()
+    assert loaded.name == 'd' and loaded.count == 3
+
+
+def check_unsupported(Sample):
+    '''
+    the features specific to the mongodb raise NotImplementedError.
+    '''
+    class Chunked(Base):
+        storage = Sample.storage
+        chunks = {'data': (10, )}
+
+    for call in [Chunked, lambda: Sample.save_many([Sample()]), lambda: Sample().save(snapshot=True)]:
+        try:
+            call()
+        except NotImplementedError:
+            continue
+        raise AssertionError('NotImplementedError is not raised: {}'.format(call))
+
+
+checks = [check_round_trip, check_lazy_binaries_kept, check_removed_binary,
+          check_projected_save, check_unsupported]
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp(prefix='dbarchive_local_')
+    try:
+        class Sample(Base):
+            storage = LocalStorage(directory)
+
+        for check in checks:
+            print 'checking {}'.format(check.__name__)
+            Sample.drop_collection()
+            check(Sample)
+        print 'all checks passed'
+    finally:
+        shutil.rmtree(directory)
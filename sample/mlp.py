@@ -62,6 +62,10 @@ class MLP(Base):
         self.optimizer = optimizers.Adam()
         self.optimizer.setup(self.model)
 
+    def __dbarchive_restore__(self):
+        self.excludes.append('xp')
+        self.xp = cuda.cupy if self.gpu >= 0 else np
+
     def forward(self, x_data, y_data, train=True):
         x, t = Variable(x_data), Variable(y_data)
         h1 = F.dropout(F.relu(self.model.l1(x)), train=train)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+'''
+Compare the archived size and the dump / restore time of PickleArchiver
+between the protocol 0 and the highest protocol of the interpreter.
+'''
+
+import time
+import numpy
+from dbarchive.base import PickleArchiver
+
+
+def measure(archiver, obj, repeat=5):
+    start = time.time()
+    for _ in range(repeat):
+        fp = archiver.dump(obj)
+    dump_time = (time.time() - start) / repeat
+    fp.seek(0, 2)
+    size = fp.tell()
+    start = time.time()
+    for _ in range(repeat):
+        fp.seek(0)
+        archiver.restore(fp)
+    restore_time = (time.time() - start) / repeat
+    return size, dump_time, restore_time
+
+
+if __name__ == '__main__':
+    objects = {
+        'dict of lists': dict(('key{}'.format(i), range(100)) for i in range(1000)),
+        'float ndarray': numpy.random.rand(1000, 1000),
+        'int ndarray': numpy.arange(1000000),
+        'list of ndarrays': [numpy.random.rand(100, 100) for _ in range(100)],
+        'strings': ['string {}'.format(i) for i in range(100000)],
+    }
+
+    legacy = PickleArchiver()
+    legacy.protocol = 0
+    highest = PickleArchiver()
+
+    print 'protocol 0 vs protocol {}'.format(highest.protocol)
+    for name, obj in sorted(objects.items()):
+        size0, dump0, restore0 = measure(legacy, obj)
+        size1, dump1, restore1 = measure(highest, obj)
+        print name
+        print '\tsize:    {:>12} -> {:>12} bytes ({:.2f}x)'.format(size0, size1, float(size0) / size1)
+        print '\tdump:    {:>12.4f} -> {:>12.4f} sec'.format(dump0, dump1)
+        print '\trestore: {:>12.4f} -> {:>12.4f} sec'.format(restore0, restore1)
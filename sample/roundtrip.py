@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+'''
+Check the round trips of the instances through the local mongodb.
+'''
+
+import numpy
+from datetime import timedelta
+from dbarchive import connect
+from dbarchive import Base
+from dbarchive import IdentityMap
+from dbarchive import collect_garbage
+from dbarchive.base import Snapshot
+
+
+class Sample(Base):
+    pass
+
+
+class Defaults(Base):
+    model = None
+
+
+class Sensor(Base):
+    appends = {'values': 100}
+
+
+class OtherSample(Base):
+    db_alias = 'other'
+
+
+def check_inline():
+    '''
+    the small binaries embedded in the document are restored as they are saved.
+    '''
+    sample = Sample()
+    sample.small = numpy.arange(10)
+    sample.obj = set([1, 2, 3])
+    sample.save()
+    assert set(sample.collection.dbarchive_inline) == set(['small', 'obj'])
+
+    loaded = Sample.objects(pk=sample.collection.pk).get()
+    assert numpy.array_equal(loaded.small, sample.small)
+    assert loaded.obj == sample.obj
+
+
+def check_identity_map():
+    '''
+    the instances restored by the querysets are reused through the identity map.
+    '''
+    Sample.identity_map = IdentityMap()
+    try:
+        sample = Sample()
+        sample.value = 1
+        sample.save()
+        first = Sample.objects.first()
+        assert Sample.objects.first() is first
+        assert list(Sample.objects)[0] is first
+        assert Sample.identity_map.stats()['hits'] >= 2
+    finally:
+        Sample.identity_map = None
+
+
+def check_collect_garbage():
+    '''
+    the binaries of the classes on the other aliases are not swept as orphans.
+    '''
+    OtherSample.drop_collection()
+    sample = OtherSample()
+    sample.large = numpy.arange(1 << 16)
+    sample.save()
+    collect_garbage(older_than=timedelta(0))
+    loaded = OtherSample.objects(pk=sample.collection.pk).get()
+    assert numpy.array_equal(loaded.large, sample.large)
+    OtherSample.drop_collection()
+
+
+def check_snapshot_chain():
+    '''
+    the delta chains of the snapshots stay shorter than snapshot_keyframe,
+    and every version is restored as it is saved.
+    '''
+    Sample.snapshot_keyframe = 3
+    try:
+        sample = Sample()
+        sample.often = numpy.zeros(100)
+        sample.rarely = numpy.zeros(100)
+        saved = {}
+        for i in range(1, 13):
+            sample.often[i] = i
+            if i % 3 == 2:
+                sample.rarely[i] = i
+            sample.save(snapshot=True)
+            saved[i] = (sample.often.copy(), sample.rarely.copy())
+        for snapshot in Snapshot.objects(parent_id=sample.collection.pk):
+            for entry in snapshot.binaries.values():
+                assert len(entry['chain']) < Sample.snapshot_keyframe
+        for i, (often, rarely) in saved.items():
+            loaded = Sample.load(sample.collection.pk, version=i)
+            assert numpy.array_equal(loaded.often, often)
+            assert numpy.array_equal(loaded.rarely, rarely)
+    finally:
+        Sample.snapshot_keyframe = 10
+
+
+def check_class_default():
+    '''
+    the binaries are not hidden by the class attributes of the same names.
+    '''
+    Defaults.drop_collection()
+    sample = Defaults()
+    sample.model = numpy.arange(1 << 16)
+    sample.save()
+    loaded = Defaults.objects.first()
+    assert numpy.array_equal(loaded.model, sample.model)
+    loaded.name = 'changed'
+    loaded.save()
+    loaded = Defaults.objects.first()
+    assert numpy.array_equal(loaded.model, sample.model)
+    Defaults.drop_collection()
+
+
+def check_appends():
+    '''
+    the appended arrays are kept when they are embedded by save_many,
+    or when appends is enabled on the arrays already embedded.
+    '''
+    Sensor.drop_collection()
+    sensor = Sensor()
+    sensor.values = numpy.zeros((2, 3))
+    Sensor.save_many([sensor])
+    sensor.values = numpy.vstack([sensor.values, numpy.ones((3, 3))])
+    sensor.save()
+    loaded = Sensor.objects(pk=sensor.collection.pk).get()
+    assert numpy.array_equal(loaded.values, sensor.values)
+
+    sample = Sample()
+    sample.values = numpy.zeros((2, 3))
+    sample.save()
+    Sample.appends = {'values': 100}
+    try:
+        loaded = Sample.objects(pk=sample.collection.pk).get()
+        loaded.values
+        loaded.save()
+        loaded.values = numpy.vstack([loaded.values, numpy.ones((3, 3))])
+        loaded.save()
+        loaded = Sample.objects(pk=sample.collection.pk).get()
+        assert numpy.array_equal(loaded.values, numpy.vstack([numpy.zeros((2, 3)), numpy.ones((3, 3))]))
+    finally:
+        Sample.appends = {}
+    Sensor.drop_collection()
+
+
+checks = [
+    check_inline, check_class_default, check_identity_map, check_collect_garbage,
+    check_snapshot_chain, check_appends
+]
+
+
+if __name__ == '__main__':
+    connect('__py_dbarchive_roundtrip')
+    connect('__py_dbarchive_roundtrip_other', alias='other')
+    for check in checks:
+        print 'checking {}'.format(check.__name__)
+        Sample.drop_collection()
+        check()
+    Sample.drop_collection()
+    print 'all checks passed'
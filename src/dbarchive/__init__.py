@@ -1,4 +1,15 @@
 #!/usr/bin/env python
 
 from base import connect
+from connection import connections
 from base import Base
+from base import ChunkedArray
+from base import collect_garbage
+from compression import ZlibCodec
+from compression import Bz2Codec
+from compression import LzmaCodec
+from cache import ArrayCache
+from identity import IdentityMap
+from instrument import instrumentation
+from registry import register_archiver
+from local import LocalStorage
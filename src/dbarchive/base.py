@@ -7,144 +7,1484 @@ Base module for implementing the abstract class for ORM
 
 import io
 import inspect
+import hashlib
 import cPickle as pickle
 from abc import ABCMeta
 from abc import abstractmethod
 from datetime import datetime
+from datetime import timedelta
 import logging
+import threading
+import itertools
 # import traceback
 from copy import deepcopy
+from collections import deque
+from collections import OrderedDict
 
 import numpy
+from numpy.lib import format as npy_format
 import pymongo
-import mongoengine
 # from mongoengine.document import Document
 from mongoengine.document import DynamicDocument
+from mongoengine.queryset import QuerySet
 from mongoengine import fields
-# from bson import Binary
+from bson import Binary
+from bson import ObjectId
+from gridfs.grid_file import DEFAULT_CHUNK_SIZE
 
-__connected = False
+from pipeline import Pipeline
+from pipeline import read_ahead
+from compression import get_codec
+from compression import ZlibCodec
+from registry import registry
+from registry import archiver_name
+from connection import connections
+from connection import default_alias
+from connection import default_database
+from instrument import instrumentation
+from instrument import instrumented
 
+# the table classes defined per (class, custom), and the attribute plans per class
+# (at most _plan_size attribute sets each)
+_tables = {}
+_plans = {}
+_plan_size = 32
 
-def connect(database="__py_dbarchive", *args, **kwargs):
+# the lock of placing the binaries into the inline dicts
+_inline_lock = threading.Lock()
+
+
+def connect(database=None, *args, **kwargs):
     '''
     the api to connect your local mongodb (by default host="localhost", port=27017).
 
-    arguments are corresponding to the mongoengine api, mongoengine.connect
-    see http://docs.mongoengine.org/apireference.html#mongoengine.connect
-    '''
-    global __connected
-    try:
-        if not __connected:
-            con = pymongo.MongoClient(*args, **kwargs)
-            con[database]
-            del con
-            mongoengine.connect(database, *args, **kwargs)
-            __connected = True
-    except:
-        logging.error('connection to the mongodb failed.')
+    arguments are corresponding to the mongoengine api, mongoengine.connect
+    see http://docs.mongoengine.org/apireference.html#mongoengine.connect
+
+    The settings are given per alias (by default 'default') with the alias keyword,
+    and the client of the alias is created only once per process.
+    Without any argument, this only checks the default alias is connected.
+    '''
+    alias = kwargs.pop('alias', default_alias)
+    if database is not None or args or kwargs:
+        kwargs.update(zip(('host', 'port'), args))
+        connections.configure(alias, database or default_database, **kwargs)
+    connect_alias(alias)
+
+
+def connect_alias(alias):
+    '''
+    connect the alias of the tables as well as the default alias of the binaries.
+    '''
+    connections.connect(default_alias)
+    if alias != default_alias:
+        connections.connect(alias)
+
+
+def reset_collections(alias):
+    '''
+    forget the collections cached by the document classes of the alias,
+    which refer to the previous client.
+    '''
+    for document in [LargeBinary, Blob, Snapshot] + list(_tables.values()):
+        if document._meta.get('db_alias', default_alias) == alias:
+            document._collection = None
+
+
+class LargeBinary(DynamicDocument):
+    '''
+    The ORM model for large binary.
+
+    Since the mongodb restrict each object size exceed to 16MB.
+    The binary beyond 16MB should be stored using the GridFS feature.
+    This table model is for dealing with the binary larger than 16MB,
+    using the FileField in mongoengine.
+
+    The detail description concerning the GridFS can be found in
+
+    - GridFS supports in mongoengine: http://docs.mongoengine.org/guide/gridfs.html
+    - GridFS: https://docs.mongodb.org/manual/core/gridfs/
+    '''
+    parent_id = fields.ObjectIdField()
+    variable = fields.StringField()
+    archiver = fields.StringField()
+    archiver_version = fields.IntField()
+    binary = fields.FileField()
+    codec = fields.StringField()
+    protocol = fields.IntField()
+    shape = fields.ListField(fields.IntField(), default=None)
+    dtype = fields.StringField()
+    chunk_shape = fields.ListField(fields.IntField(), default=None)
+    chunk_files = fields.DictField()
+    chunk_digests = fields.DictField()
+    segments = fields.ListField(fields.DictField(), default=None)
+    digest = fields.StringField()
+    deduplicated = fields.BooleanField(default=False)
+    updated = fields.DateTimeField(default=None)
+
+
+class Blob(DynamicDocument):
+    '''
+    The ORM model for the content addressed binary shared among LargeBinary entries.
+
+    The blob is keyed by the digest of its content and stored in the GridFS only once.
+    The LargeBinary entries refer to the same GridFS file, and the blob is
+    garbage collected when its reference count reaches zero.
+    '''
+    digest = fields.StringField(unique=True)
+    binary = fields.FileField()
+    refcount = fields.IntField(default=0)
+
+    @classmethod
+    def acquire(cls, digest, fp):
+        '''
+        increment the reference count of the blob, and returns the blob.
+
+        The blob and its file id are inserted atomically with the increment,
+        and the content is uploaded from fp only by the acquirer which inserted the blob,
+        so that the concurrent acquirers of a new digest never upload it twice.
+        '''
+        file_id = ObjectId()
+        row = cls._get_collection().find_one_and_update(
+            {'digest': digest},
+            {'$setOnInsert': {'binary': file_id}, '$inc': {'refcount': 1}},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if row['binary'] == file_id:
+            write_files([fp], cls.binary.collection_name, file_ids=[file_id])
+        return cls._from_son(row)
+
+    @classmethod
+    def release(cls, digest):
+        '''
+        decrement the reference count of the blob, and delete it when the count reaches zero.
+        '''
+        cls.objects(digest=digest).update_one(dec__refcount=1)
+        blob = cls.objects(digest=digest, refcount__lte=0).modify(remove=True)
+        if blob is not None:
+            logging.debug('garbage collecting blob: {}'.format(digest))
+            blob.binary.delete()
+
+    @classmethod
+    def release_many(cls, counts):
+        '''
+        decrement the reference counts of the blobs by the dict of the digest to the count,
+        and delete the blobs whose counts reach zero with their GridFS files in bulk.
+        '''
+        file_ids = []
+        for digest, count in counts.items():
+            cls.objects(digest=digest).update_one(dec__refcount=count)
+            blob = cls.objects(digest=digest, refcount__lte=0).modify(remove=True)
+            if blob is not None and blob.binary.grid_id is not None:
+                file_ids.append(blob.binary.grid_id)
+        delete_files(file_ids, cls.binary.collection_name)
+
+
+connections.listeners.append(reset_collections)
+
+
+class Snapshot(DynamicDocument):
+    '''
+    The ORM model for a version of the instance saved with snapshot.
+
+    The natives are stored in the document as they are.
+    Each binary is stored as its archived bytes compressed with zlib (keyframe),
+    or as the xor of them and the archived bytes of the previous version compressed with zlib (delta).
+    The binary entry has the chain of the GridFS files from its keyframe to itself,
+    and the binary not changed from the previous version shares its entry.
+    '''
+    parent_id = fields.ObjectIdField()
+    version = fields.IntField()
+    created = fields.DateTimeField()
+    natives = fields.DictField()
+    binaries = fields.DictField()
+    meta = {'indexes': [{'fields': ['parent_id', 'version'], 'unique': True}]}
+
+
+def release_binary(binary):
+    '''
+    delete the GridFS file of the LargeBinary entry,
+    or release its reference to the shared blob if it is deduplicated.
+    The segments appended to the binary are deleted as well.
+    '''
+    if binary.segments:
+        delete_files([segment['file'] for segment in binary.segments], LargeBinary.binary.collection_name)
+        binary.segments = None
+    if binary.chunk_shape:
+        delete_files(list(binary.chunk_files.values()), LargeBinary.binary.collection_name)
+        binary.shape = binary.dtype = binary.chunk_shape = None
+        binary.chunk_files = {}
+        binary.chunk_digests = {}
+    elif binary.deduplicated:
+        Blob.release(binary.digest)
+        binary.binary = None
+    elif binary.binary.grid_id is not None:
+        binary.binary.delete()
+
+
+def delete_binaries(pairs):
+    '''
+    delete the LargeBinary entries of the (parent id, variable) pairs with their GridFS files.
+    '''
+    pairs = set(pairs)
+    if not pairs:
+        return
+    parent_ids = list(set(parent_id for parent_id, _ in pairs))
+    for binary in LargeBinary.objects.filter(parent_id__in=parent_ids):
+        if (binary.parent_id, binary.variable) in pairs:
+            release_binary(binary)
+            binary.delete()
+
+
+def purge_binaries(query):
+    '''
+    delete the LargeBinary entries matching the raw query with their GridFS files in bulk,
+    and returns the number of the deleted entries.
+
+    The entries are read with a single query projecting only the file references,
+    and the GridFS files and the entries are deleted with delete_many
+    instead of deleting them one by one.
+    '''
+    collection = LargeBinary._get_collection()
+    file_ids = []
+    digests = {}
+    projection = ['binary', 'chunk_shape', 'chunk_files', 'segments', 'deduplicated', 'digest']
+    for row in collection.find(query, projection):
+        file_ids.extend(segment['file'] for segment in row.get('segments') or [])
+        if row.get('chunk_shape'):
+            file_ids.extend((row.get('chunk_files') or {}).values())
+        elif row.get('deduplicated'):
+            digests[row['digest']] = digests.get(row['digest'], 0) + 1
+        elif row.get('binary') is not None:
+            file_ids.append(row['binary'])
+    Blob.release_many(digests)
+    delete_files(file_ids, LargeBinary.binary.collection_name)
+    return collection.delete_many(query).deleted_count
+
+
+def purge_snapshots(query):
+    '''
+    delete the snapshots matching the raw query with their GridFS files in bulk,
+    and returns the number of the deleted snapshots.
+
+    The snapshots of a document should be deleted all together,
+    since the later versions depend on the files of the earlier ones.
+    '''
+    collection = Snapshot._get_collection()
+    file_ids = set()
+    for row in collection.find(query, ['binaries']):
+        for entry in (row.get('binaries') or {}).values():
+            file_ids.update(entry['chain'])
+    delete_files(list(file_ids), LargeBinary.binary.collection_name)
+    return collection.delete_many(query).deleted_count
+
+
+def xor_bytes(data, base):
+    '''
+    returns the xor of the bytes, where base is padded with zeros or truncated to the length of data.
+    '''
+    data = numpy.frombuffer(data, numpy.uint8)
+    padded = numpy.zeros(len(data), numpy.uint8)
+    base = numpy.frombuffer(base, numpy.uint8)[:len(data)]
+    padded[:len(base)] = base
+    return (data ^ padded).tobytes()
+
+
+def restore_snapshot(snapshot, variables=None):
+    '''
+    returns the dict of the variable to the archived bytes of the binaries in the snapshot,
+    or only of the given variables.
+
+    The files of all the chains are read with a single query,
+    and the deltas are applied from the keyframe in order.
+    '''
+    binaries = dict(
+        (k, entry) for k, entry in snapshot.binaries.items() if variables is None or k in variables)
+    file_ids = set()
+    for entry in binaries.values():
+        file_ids.update(entry['chain'])
+    streams = read_files(list(file_ids), LargeBinary.binary.collection_name)
+    codec = ZlibCodec()
+    decompressed = {}
+    raws = {}
+    for k, entry in binaries.items():
+        raw = None
+        for file_id in entry['chain']:
+            if file_id not in decompressed:
+                decompressed[file_id] = codec.decompress(streams[file_id]).read()
+            data = decompressed[file_id]
+            raw = data if raw is None else xor_bytes(data, raw)
+        raws[k] = raw
+    return raws
+
+
+def delete_documents(table, parent_ids):
+    '''
+    delete the documents of the table and their binaries and snapshots in bulk.
+    '''
+    if not parent_ids:
+        return 0
+    purge_binaries({'parent_id': {'$in': parent_ids}})
+    purge_snapshots({'parent_id': {'$in': parent_ids}})
+    return table._get_collection().delete_many({'_id': {'$in': parent_ids}}).deleted_count
+
+
+def batched(iterable, size):
+    '''
+    yields the lists of at most size items of the iterable.
+    '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def collect_garbage(older_than=timedelta(hours=1), batch_size=1000):
+    '''
+    sweep the binaries left behind by the crashed saves or deletions.
+
+    The following ones created before older_than are deleted,
+    so that the binaries being saved concurrently are not swept.
+
+    - the LargeBinary entries whose documents do not exist, or whose upload is not completed
+    - the blobs no longer referred from any LargeBinary entry
+    - the snapshots whose documents do not exist
+    - the GridFS files and chunks not referred from any LargeBinary entry, blob nor snapshot
+
+    All the collections other than the ones of dbarchive, in the databases of
+    all the configured aliases, are regarded as the tables of the Base classes.
+    Configure the aliases of all the Base classes sharing the binaries before the call,
+    otherwise the binaries of the classes on the other aliases are swept as orphans.
+    returns the dict of the numbers of the deleted entries.
+    '''
+    connect()
+    db = LargeBinary._get_db()
+    fs = LargeBinary.binary.collection_name
+    binaries = LargeBinary._get_collection()
+    blobs = Blob._get_collection()
+    snapshots = Snapshot._get_collection()
+    utilities = set([binaries.name, blobs.name, snapshots.name, fs + '.files', fs + '.chunks'])
+    tables = [
+        database[name]
+        for database in connections.databases().values()
+        for name in database.collection_names(include_system_collections=False)
+        if name not in utilities
+    ]
+    deadline = ObjectId.from_datetime(datetime.utcnow() - older_than)
+    stats = {'binaries': 0, 'blobs': 0, 'snapshots': 0, 'files': 0, 'chunks': 0}
+
+    def existing(parent_ids):
+        ids = set()
+        for table in tables:
+            ids.update(doc['_id'] for doc in table.find({'_id': {'$in': parent_ids}}, ['_id']))
+        return ids
+
+    rows = binaries.find({'_id': {'$lt': deadline}}, ['parent_id', 'updated'])
+    for batch in batched(rows, batch_size):
+        parents = existing(list(set(row['parent_id'] for row in batch)))
+        orphans = [
+            row['_id'] for row in batch
+            if row['parent_id'] not in parents or row.get('updated') is None
+        ]
+        if orphans:
+            stats['binaries'] += purge_binaries({'_id': {'$in': orphans}})
+
+    released = blobs.find({'_id': {'$lt': deadline}, 'refcount': {'$lte': 0}}, ['digest'])
+    for batch in batched(released, batch_size):
+        digests = [blob['digest'] for blob in batch]
+        Blob.release_many(dict((digest, 0) for digest in digests))
+        stats['blobs'] += len(digests)
+
+    rows = snapshots.find({'_id': {'$lt': deadline}}, ['parent_id'])
+    for batch in batched(rows, batch_size):
+        parent_ids = list(set(row['parent_id'] for row in batch))
+        parents = existing(parent_ids)
+        orphans = [parent_id for parent_id in parent_ids if parent_id not in parents]
+        if orphans:
+            stats['snapshots'] += purge_snapshots({'parent_id': {'$in': orphans}})
+
+    referred = set()
+    for row in snapshots.find({}, ['binaries']):
+        for entry in (row.get('binaries') or {}).values():
+            referred.update(entry['chain'])
+    for row in binaries.find({}, ['binary', 'chunk_files', 'segments']):
+        if row.get('binary') is not None:
+            referred.add(row['binary'])
+        referred.update((row.get('chunk_files') or {}).values())
+        referred.update(segment['file'] for segment in row.get('segments') or [])
+    referred.update(blob['binary'] for blob in blobs.find({}, ['binary']) if blob.get('binary') is not None)
+
+    files = db[fs + '.files'].find({'_id': {'$lt': deadline}}, ['_id'])
+    for batch in batched(files, batch_size):
+        file_ids = [f['_id'] for f in batch if f['_id'] not in referred]
+        delete_files(file_ids, fs)
+        stats['files'] += len(file_ids)
+
+    # the chunks are written before their file documents, so the chunks without them are left on crash
+    heads = db[fs + '.chunks'].find({'files_id': {'$lt': deadline}, 'n': 0}, ['files_id'])
+    for batch in batched(heads, batch_size):
+        file_ids = [chunk['files_id'] for chunk in batch]
+        present = set(f['_id'] for f in db[fs + '.files'].find({'_id': {'$in': file_ids}}, ['_id']))
+        file_ids = [file_id for file_id in file_ids if file_id not in present]
+        if file_ids:
+            stats['chunks'] += db[fs + '.chunks'].delete_many({'files_id': {'$in': file_ids}}).deleted_count
+    return stats
+
+
+def stream_size(fp):
+    '''
+    returns the size of the file stream, which is rewound to the head.
+    '''
+    fp.seek(0, 2)
+    size = fp.tell()
+    fp.seek(0)
+    return size
+
+
+def digest_of(fp, chunk_size=1 << 20):
+    '''
+    returns the sha1 hex digest of the file stream content.
+    '''
+    sha1 = hashlib.sha1()
+    fp.seek(0)
+    for chunk in iter(lambda: fp.read(chunk_size), b''):
+        sha1.update(chunk)
+    fp.seek(0)
+    return sha1.hexdigest()
+
+
+def read_files(file_ids, collection_name='fs'):
+    '''
+    read the GridFS files at once and returns the dict of the file id to its file stream.
+
+    The chunks of all the files are fetched with a single query sorted by the GridFS index,
+    instead of opening the files one by one.
+    '''
+    chunks = dict((file_id, []) for file_id in file_ids)
+    cursor = LargeBinary._get_db()[collection_name + '.chunks'].find(
+        {'files_id': {'$in': file_ids}}
+    ).sort([('files_id', pymongo.ASCENDING), ('n', pymongo.ASCENDING)])
+    for chunk in cursor:
+        chunks[chunk['files_id']].append(chunk['data'])
+    return dict((file_id, io.BytesIO(b''.join(data))) for file_id, data in chunks.items())
+
+
+def write_files(streams, collection_name='fs', chunk_size=DEFAULT_CHUNK_SIZE, file_ids=None):
+    '''
+    write the file streams into the GridFS at once and returns the list of the file ids.
+    The file ids are generated unless they are given.
+
+    The chunks of all the files are inserted with a single insert_many,
+    followed by a single insert_many of the file documents,
+    instead of putting the files one by one.
+    '''
+    db = LargeBinary._get_db()
+    given = iter(file_ids or [])
+    file_ids = []
+    files = []
+    chunks = []
+    for fp in streams:
+        file_id = next(given, None) or ObjectId()
+        length = 0
+        fp.seek(0)
+        for n, data in enumerate(iter(lambda: fp.read(chunk_size), b'')):
+            chunks.append({'files_id': file_id, 'n': n, 'data': Binary(data)})
+            length += len(data)
+        files.append({
+            '_id': file_id,
+            'length': length,
+            'chunkSize': chunk_size,
+            'uploadDate': datetime.utcnow()
+        })
+        file_ids.append(file_id)
+    if chunks:
+        db[collection_name + '.chunks'].insert_many(chunks, ordered=False)
+    if files:
+        db[collection_name + '.files'].insert_many(files, ordered=False)
+    return file_ids
+
+
+def delete_files(file_ids, collection_name='fs'):
+    '''
+    delete the GridFS files at once.
+    '''
+    if not file_ids:
+        return
+    db = LargeBinary._get_db()
+    db[collection_name + '.files'].delete_many({'_id': {'$in': file_ids}})
+    db[collection_name + '.chunks'].delete_many({'files_id': {'$in': file_ids}})
+
+
+class Archiver(object):
+    '''
+    the superclass for archiving the mogoengine unsupporting variables in the class.
+
+    The child class of this class should have dump / restore methods
+    for handling the binary expression of the variable.
+    dump() method be also with post_dump decorator as well as
+    restore() method be with pre_restore decorator.
+
+    See PickleArchiver, NpyArchiver for more concrete example.
+
+    The name (the class name by default) and the version are recorded on LargeBinary,
+    and the archiver is looked up by them from the registry on restore.
+    Increment the version when the binary format of the archiver is changed.
+    '''
+    __metaclass__ = ABCMeta
+    name = None
+    version = 1
+
+    @abstractmethod
+    def dump(self, obj):
+        '''
+        Accept any object as an argument and dump it into a file stream
+        '''
+        return None
+
+    @abstractmethod
+    def restore(self, obj):
+        '''
+        Accept file stream and restore it as a input variable style.
+        '''
+        return None
+
+
+class PickleArchiver(Archiver):
+    '''
+    The Archiver implementation with pickle format.
+
+    The object is pickled with the highest protocol of the interpreter,
+    which is recorded on LargeBinary.
+    '''
+    protocol = pickle.HIGHEST_PROTOCOL
+
+    def dump(self, obj):
+        bio = io.BytesIO()
+        pickle.dump(obj, bio, self.protocol)
+        return bio
+
+    def restore(self, fp):
+        fp.seek(0)
+        return pickle.load(fp)
+
+
+class NpyStream(object):
+    '''
+    The readable stream of the npy format over the buffer of the array.
+
+    The npy header is followed by the raw buffer of the array,
+    which is read chunk by chunk without copying the whole array into memory.
+    '''
+    def __init__(self, array):
+        bio = io.BytesIO()
+        header = npy_format.header_data_from_array_1_0(array)
+        npy_format.write_array_header_1_0(bio, header)
+        self.header = bio.getvalue()
+        if header['fortran_order']:
+            array = array.T
+        else:
+            array = numpy.ascontiguousarray(array)
+        self.buffer = array.reshape(-1).view(numpy.uint8)
+        self.length = len(self.header) + len(self.buffer)
+        self.position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.position
+        start = self.position
+        end = min(start + size, self.length)
+        self.position = end
+        header_size = len(self.header)
+        data = b''
+        if start < header_size:
+            data = self.header[start:min(end, header_size)]
+        if end > header_size:
+            data += self.buffer[max(start - header_size, 0):end - header_size].tobytes()
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+class NpyArchiver(Archiver):
+    '''
+    The Archiver implementation with npy format.
+
+    The array is streamed from its buffer on dump and restored into
+    the preallocated array chunk by chunk, so that the peak memory stays
+    close to the array size. The arrays of object dtype are pickled by numpy.
+    '''
+    chunk_size = 1 << 22
+
+    def dump(self, obj):
+        if obj.dtype.hasobject:
+            bio = io.BytesIO()
+            numpy.save(bio, obj)
+            return bio
+        return NpyStream(obj)
+
+    def restore(self, fp):
+        version = npy_format.read_magic(fp)
+        if version == (1, 0):
+            shape, fortran_order, dtype = npy_format.read_array_header_1_0(fp)
+        else:
+            shape, fortran_order, dtype = npy_format.read_array_header_2_0(fp)
+        if dtype.hasobject:
+            fp.seek(0)
+            return numpy.load(fp)
+
+        array = numpy.empty(shape[::-1] if fortran_order else shape, dtype)
+        buf = array.reshape(-1).view(numpy.uint8)
+        offset = 0
+        while offset < len(buf):
+            data = fp.read(min(self.chunk_size, len(buf) - offset))
+            if not data:
+                raise ValueError('the npy stream is truncated')
+            buf[offset:offset + len(data)] = numpy.frombuffer(data, numpy.uint8)
+            offset += len(data)
+        return array.T if fortran_order else array
+
+
+class ShuffleNpyArchiver(NpyArchiver):
+    '''
+    The NpyArchiver with the byte-shuffle filter for the numeric arrays.
+
+    The bytes of the array elements are regrouped by their significance,
+    which makes the numeric arrays much more compressible.
+    It is intended to be used with the compression codecs.
+    '''
+    @staticmethod
+    def shuffled(dtype):
+        return dtype.kind in 'biufc' and dtype.itemsize > 1
+
+    def dump(self, obj):
+        if obj.dtype.hasobject or not self.shuffled(obj.dtype):
+            return super(ShuffleNpyArchiver, self).dump(obj)
+        array = numpy.ascontiguousarray(obj)
+        stream = NpyStream(array)
+        stream.buffer = array.reshape(-1).view(numpy.uint8).reshape(-1, array.dtype.itemsize).T.ravel()
+        return stream
+
+    def restore(self, fp):
+        array = super(ShuffleNpyArchiver, self).restore(fp)
+        if array.dtype.hasobject or not self.shuffled(array.dtype):
+            return array
+        itemsize = array.dtype.itemsize
+        shuffled = array.reshape(-1).view(numpy.uint8).reshape(itemsize, -1)
+        result = numpy.empty(array.shape, array.dtype)
+        result.reshape(-1).view(numpy.uint8).reshape(-1, itemsize)[:] = shuffled.T
+        return result
+
+
+class CompressedArchiver(Archiver):
+    '''
+    The Archiver wrapping another archiver with the compression codec.
+
+    The name of the wrapped archiver and the codec are recorded on LargeBinary,
+    so that the binary is decompressed automatically on restore.
+    '''
+    def __init__(self, archiver, codec):
+        self.archiver = archiver
+        self.codec = codec
+
+    def dump(self, obj):
+        fp = self.archiver.dump(obj)
+        record = instrumentation.current()
+        if record:
+            record.add(raw_bytes=stream_size(fp))
+        return self.codec.compress(fp)
+
+    def restore(self, fp):
+        return self.archiver.restore(self.codec.decompress(fp))
+
+
+class MatrixArchiver(NpyArchiver):
+    '''
+    The NpyArchiver restoring the array as numpy.matrix.
+    '''
+    def restore(self, fp):
+        return numpy.asmatrix(super(MatrixArchiver, self).restore(fp))
+
+
+# the masked arrays are pickled to keep their masks
+registry.register(PickleArchiver(), [numpy.ma.MaskedArray])
+registry.register(NpyArchiver(), [numpy.ndarray])
+registry.register(ShuffleNpyArchiver())
+if hasattr(numpy, 'matrix'):
+    registry.register(MatrixArchiver(), [numpy.matrix])
+
+
+def describe_archiver(archiver):
+    '''
+    returns the dict of the archiver name, the codec name and the pickle protocol
+    to be recorded on LargeBinary.
+    '''
+    codec = None
+    if isinstance(archiver, CompressedArchiver):
+        codec = archiver.codec.name
+        archiver = archiver.archiver
+    return {
+        'archiver': archiver_name(archiver),
+        'archiver_version': getattr(archiver, 'version', None),
+        'codec': codec,
+        'protocol': getattr(archiver, 'protocol', None)
+    }
+
+
+def restoring_archiver(binary):
+    '''
+    returns the archiver restoring the binary of the LargeBinary entry.
+    '''
+    archiver = registry.get(binary.archiver, binary.archiver_version)
+    if binary.codec:
+        archiver = CompressedArchiver(archiver, get_codec(binary.codec))
+    return archiver
+
+
+def chunk_name(index):
+    '''
+    returns the key of the chunk index used in the LargeBinary entry.
+    '''
+    return 'c' + '_'.join(str(i) for i in index)
+
+
+class ChunkedArray(object):
+    '''
+    The lazy array-like handle of the ndarray stored in fixed shape chunks.
+
+    Each chunk is stored in its own GridFS file with the npy format,
+    and its file id is recorded on the LargeBinary entry.
+    Indexing the handle reads only the chunks it touches,
+    and assigning a region rewrites only the chunks it changes.
+
+    The index of each axis is an integer, a slice or a 1-d integer / boolean array.
+    The arrays are applied to each axis independently (orthogonal indexing).
+    '''
+    def __init__(self, binary):
+        self.binary = binary
+        self.shape = tuple(binary.shape)
+        self.dtype = numpy.dtype(str(binary.dtype))
+        self.chunk_shape = tuple(binary.chunk_shape)
+
+    @classmethod
+    def store(cls, parent_id, variable, array, chunk_shape=()):
+        '''
+        store the array in chunks as the variable of the document, and returns the handle.
+
+        chunk_shape is the chunk length of each leading axis, where None means the whole axis.
+        If the stored array has the same shape, dtype and chunk shape,
+        only the chunks changed are rewritten.
+        '''
+        array = numpy.asarray(array)
+        if array.dtype.hasobject:
+            raise ValueError('the array of object dtype cannot be stored in chunks: {}'.format(variable))
+        chunk_shape = tuple(chunk_shape) + (None,) * (array.ndim - len(chunk_shape))
+        chunk_shape = [
+            max(1, min(c or n, n)) for c, n in zip(chunk_shape[:array.ndim], array.shape)
+        ]
+
+        binary = LargeBinary.objects(
+            parent_id=parent_id, variable=variable
+        ).modify(
+            upsert=True, new=True,
+            set__parent_id=parent_id,
+            set__variable=variable
+        )
+        if not (binary.chunk_shape and
+                list(binary.shape) == list(array.shape) and
+                binary.dtype == array.dtype.str and
+                list(binary.chunk_shape) == chunk_shape):
+            if binary.updated is not None:
+                release_binary(binary)
+            binary.shape = list(array.shape)
+            binary.dtype = array.dtype.str
+            binary.chunk_shape = chunk_shape
+            binary.chunk_files = {}
+            binary.chunk_digests = {}
+            binary.archiver = archiver_name(NpyArchiver)
+            binary.archiver_version = NpyArchiver.version
+            binary.codec = None
+            binary.digest = None
+            binary.deduplicated = False
+            binary.updated = datetime.now()
+            binary.save()
+        handle = cls(binary)
+        handle.written = handle.assign(Ellipsis, array)
+        return handle
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(numpy.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'ChunkedArray(shape={}, dtype={}, chunks={})'.format(
+            self.shape, self.dtype, self.chunk_shape)
+
+    def __array__(self, dtype=None):
+        array = self[...]
+        return array if dtype is None else array.astype(dtype)
+
+    def __getitem__(self, key):
+        indices, squeeze = self.normalize(key)
+        result = numpy.empty([len(i) for i in indices], self.dtype)
+        selections = self.selections(indices)
+        chunks = self.read_chunks([index for index, _, _ in selections])
+        for index, positions, local in selections:
+            result[numpy.ix_(*positions)] = chunks[index][numpy.ix_(*local)]
+        return self.squeeze(result, squeeze)
+
+    def __setitem__(self, key, value):
+        self.assign(key, value)
+
+    def assign(self, key, value):
+        '''
+        write the value into the region, and returns the names of the chunks rewritten.
+        '''
+        indices, squeeze = self.normalize(key)
+        expanded = numpy.empty([len(i) for i in indices], self.dtype)
+        self.squeeze(expanded, squeeze)[...] = value
+        selections = self.selections(indices)
+        partial = [
+            index for index, _, local in selections
+            if any(len(l) != n for l, n in zip(local, self.extent(index)))
+        ]
+        chunks = self.read_chunks(partial)
+        for index, positions, local in selections:
+            if index not in chunks:
+                chunks[index] = numpy.empty(self.extent(index), self.dtype)
+            chunks[index][numpy.ix_(*local)] = expanded[numpy.ix_(*positions)]
+        return self.write_chunks(chunks)
+
+    def normalize(self, key):
+        '''
+        returns the list of the indices of each axis and the axes to be squeezed.
+        '''
+        if not isinstance(key, tuple):
+            key = (key, )
+        for axis, k in enumerate(key):
+            if k is Ellipsis:
+                key = key[:axis] + (slice(None), ) * (self.ndim - len(key) + 1) + key[axis + 1:]
+                break
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for the array')
+        key = key + (slice(None), ) * (self.ndim - len(key))
+
+        indices = []
+        squeeze = []
+        for axis, (k, n) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                indices.append(numpy.arange(*k.indices(n)))
+                continue
+            if isinstance(k, (int, long, numpy.integer)):
+                squeeze.append(axis)
+            index = numpy.asarray(k)
+            if index.dtype == bool:
+                index = numpy.nonzero(index)[0]
+            index = index.astype(numpy.intp).reshape(-1)
+            index = numpy.where(index < 0, index + n, index)
+            if len(index) and (index.min() < 0 or index.max() >= n):
+                raise IndexError('index out of bounds for the axis {} with size {}'.format(axis, n))
+            indices.append(index)
+        return indices, squeeze
+
+    def squeeze(self, array, axes):
+        if not axes:
+            return array
+        return array.reshape([n for axis, n in enumerate(array.shape) if axis not in axes])
+
+    def extent(self, index):
+        '''
+        returns the shape of the chunk, which is smaller than chunk_shape at the edges.
+        '''
+        return tuple(min(c, n - i * c) for i, c, n in zip(index, self.chunk_shape, self.shape))
+
+    def selections(self, indices):
+        '''
+        returns the list of (chunk index, positions in the selection, positions in the chunk)
+        for the chunks touched by the indices.
+        '''
+        owners = [index // c for index, c in zip(indices, self.chunk_shape)]
+        selections = []
+        for chunk_index in itertools.product(*[numpy.unique(o) for o in owners]):
+            chunk_index = tuple(int(i) for i in chunk_index)
+            positions = [numpy.nonzero(o == i)[0] for o, i in zip(owners, chunk_index)]
+            local = [
+                index[p] - i * c
+                for index, p, i, c in zip(indices, positions, chunk_index, self.chunk_shape)
+            ]
+            selections.append((chunk_index, positions, local))
+        return selections
+
+    def read_chunks(self, indices):
+        '''
+        read the chunks at once and returns the dict of the chunk index to the chunk array.
+        '''
+        files = dict(
+            (index, self.binary.chunk_files.get(chunk_name(index))) for index in indices
+        )
+        streams = read_files(
+            [f for f in files.values() if f is not None], LargeBinary.binary.collection_name)
+        archiver = NpyArchiver()
+        chunks = {}
+        for index, file_id in files.items():
+            if file_id is None:
+                chunks[index] = numpy.zeros(self.extent(index), self.dtype)
+            else:
+                chunks[index] = archiver.restore(streams[file_id])
+        return chunks
+
+    def write_chunks(self, chunks):
+        '''
+        write the chunks changed at once, and returns the names of the chunks written.
+        '''
+        archiver = NpyArchiver()
+        names = []
+        streams = []
+        digests = []
+        for index, chunk in chunks.items():
+            name = chunk_name(index)
+            fp = archiver.dump(chunk)
+            digest = digest_of(fp)
+            if self.binary.chunk_digests.get(name) == digest:
+                continue
+            names.append(name)
+            streams.append(fp)
+            digests.append(digest)
+        if not names:
+            return names
+
+        collection_name = LargeBinary.binary.collection_name
+        file_ids = write_files(streams, collection_name)
+        olds = [self.binary.chunk_files[n] for n in names if n in self.binary.chunk_files]
+        update = {'updated': datetime.now()}
+        for name, file_id, digest in zip(names, file_ids, digests):
+            update['chunk_files.' + name] = file_id
+            update['chunk_digests.' + name] = digest
+            self.binary.chunk_files[name] = file_id
+            self.binary.chunk_digests[name] = digest
+        LargeBinary._get_collection().update_one({'_id': self.binary.pk}, {'$set': update})
+        delete_files(olds, collection_name)
+        return names
+
+
+class InlineBinary(object):
+    '''
+    The binary embedded in the document of the table in place of the LargeBinary entry.
+
+    The archived bytes are stored as BSON Binary in the dbarchive_inline field of the document,
+    tagged with the archiver name and version, the codec and the digest.
+    '''
+    chunk_shape = None
+
+    def __init__(self, variable, entry):
+        self.variable = variable
+        self.archiver = entry['archiver']
+        self.archiver_version = entry.get('archiver_version')
+        self.codec = entry.get('codec')
+        self.protocol = entry.get('protocol')
+        self.digest = entry.get('digest')
+        self.data = entry['data']
+
+
+class LazyBinary(object):
+    '''
+    The proxy for the binary attribute which is not restored yet.
+
+    The GridFS file is read and restored with the archiver on the first call of load(),
+    and the restored value is cached for the later calls.
+    If the file stream is already fetched, it is given as fp and restored without reading the GridFS.
+    '''
+    def __init__(self, binary, fp=None, cache=None):
+        self.binary = binary
+        self.variable = binary.variable
+        self.digest = binary.digest
+        self.fp = fp
+        self.cache = cache
+        self.loaded = False
+        self.value = None
+
+    def load(self):
+        '''
+        restore the binary from the GridFS and returns it.
+        '''
+        if not self.loaded:
+            if self.binary.chunk_shape:
+                self.value = ChunkedArray(self.binary)
+            else:
+                with instrumentation.measure('restore', attribute=self.variable) as record:
+                    self.value = self.restore()
+                    segments = getattr(self.binary, 'segments', None)
+                    if segments:
+                        self.value = restore_segments(self.value, segments)
+                    if record:
+                        record.raw_bytes = getattr(self.value, 'nbytes', 0)
+            self.loaded = True
+            self.binary = None
+            self.fp = None
+        return self.value
+
+    def restore(self):
+        '''
+        restore the binary with the archiver, through the local array cache if it is given.
+
+        The npy files without codec are copied into the cache as they are,
+        and the other arrays are cached after they are restored.
+        '''
+        fp = self.binary.binary if self.fp is None else self.fp
+        if self.cache is None:
+            return restoring_archiver(self.binary).restore(fp)
+
+        key = cache_key(self.binary)
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+        if self.binary.archiver == archiver_name(NpyArchiver) and not self.binary.codec:
+            value = self.cache.put_stream(key, fp)
+            if value is not None:
+                return value
+            fp.seek(0)
+        value = restoring_archiver(self.binary).restore(fp)
+        if type(value) is numpy.ndarray and not value.dtype.hasobject:
+            value = self.cache.put(key, value)
+        return value
+
+
+def restore_segments(array, segments):
+    '''
+    returns the array concatenating the rows of the appended segments to the array.
+
+    The GridFS files of all the segments are read with a single query,
+    and restored into the preallocated array one by one.
+    '''
+    streams = read_files([segment['file'] for segment in segments], LargeBinary.binary.collection_name)
+    rows = len(array) + sum(segment['rows'] for segment in segments)
+    result = numpy.empty((rows, ) + array.shape[1:], array.dtype)
+    result[:len(array)] = array
+    offset = len(array)
+    archiver = NpyArchiver()
+    for segment in segments:
+        result[offset:offset + segment['rows']] = archiver.restore(streams[segment['file']])
+        offset += segment['rows']
+    return result
+
+
+def projected(variable, projection):
+    '''
+    returns True if the binary of the variable is loaded in the projection.
+    '''
+    if projection is None:
+        return True
+    only, excludes = projection
+    return (only is None or variable in only) and variable not in excludes
+
+
+def unprojected(projection):
+    '''
+    returns True if all the fields are loaded in the projection.
+    '''
+    if projection is None:
+        return True
+    only, excludes = projection
+    return only is None and not excludes
+
+
+def cache_key(binary):
+    '''
+    returns the key of the LargeBinary entry in the local array cache.
+
+    The key consists of the entry id and its content digest, or its updated time
+    for the entries stored without digest, so that the updated binary gets a new key.
+    '''
+    version = binary.digest or binary.updated.strftime('%Y%m%d%H%M%S%f')
+    return '{}-{}'.format(binary.pk, version)
+
+
+class BinaryQuerySet(QuerySet):
+    '''
+    The queryset for the classes inheritating the Base class.
+
+    The documents are read from the cursor per batch, and the LargeBinary entries
+    of all the documents in the batch are fetched with a single query,
+    instead of querying them for each document.
+    With prefetch_binaries(), the GridFS files of the batch are also read at once.
+
+    With only() / exclude() / exclude_binaries(), the binaries not requested
+    are neither fetched from LargeBinary nor restored.
+    '''
+    batch_size = 100
+
+    def __init__(self, *args, **kwargs):
+        super(BinaryQuerySet, self).__init__(*args, **kwargs)
+        self._binary_buffer = deque()
+        self._binary_batch_size = self.batch_size
+        self._binary_read = False
+        self._binary_only = None
+        self._binary_excludes = frozenset()
+
+    def prefetch_binaries(self, batch_size=None, read=True):
+        '''
+        returns the queryset reading the GridFS files of each batch in bulk.
+        '''
+        queryset = self.clone()
+        if batch_size is not None:
+            queryset._binary_batch_size = batch_size
+        queryset._binary_read = read
+        return queryset
+
+    def only(self, *fields):
+        '''
+        returns the queryset loading only the fields and the binaries of the names.
+
+        The small binaries embedded in the document are projected together
+        and only the requested ones are restored.
+        '''
+        queryset = super(BinaryQuerySet, self).only(*(fields + ('dbarchive_inline', )))
+        queryset._binary_only = frozenset(fields)
+        return queryset
+
+    def exclude(self, *fields):
+        '''
+        returns the queryset loading neither the fields nor the binaries of the names.
+        '''
+        queryset = super(BinaryQuerySet, self).exclude(*fields)
+        queryset._binary_excludes = self._binary_excludes | frozenset(fields)
+        return queryset
+
+    def exclude_binaries(self, *names):
+        '''
+        returns the queryset not loading the binaries of the names.
+        '''
+        queryset = self.clone()
+        queryset._binary_excludes = self._binary_excludes | frozenset(names)
+        return queryset
+
+    def all_fields(self):
+        queryset = super(BinaryQuerySet, self).all_fields()
+        queryset._binary_only = None
+        queryset._binary_excludes = frozenset()
+        return queryset
+
+    def _clone_into(self, new_qs):
+        new_qs = super(BinaryQuerySet, self)._clone_into(new_qs)
+        new_qs._binary_batch_size = self._binary_batch_size
+        new_qs._binary_read = self._binary_read
+        new_qs._binary_only = self._binary_only
+        new_qs._binary_excludes = self._binary_excludes
+        return new_qs
+
+    def stream(self, batch_size=None, prefetch=1):
+        '''
+        yields the class instances of the queryset keeping only a few batches in memory.
+
+        While the caller processes the current batch, the next prefetch batches are
+        fetched in background together with their GridFS files.
+        The instances are not cached in the queryset and they are released
+        once they are yielded, unless the caller or identity_map keeps them.
+        '''
+        queryset = self.clone()
+        batch_size = batch_size or queryset._binary_batch_size
+        cursor = queryset._cursor
+        cursor.batch_size(batch_size)
+
+        def batches():
+            while True:
+                raw_docs = list(itertools.islice(cursor, batch_size))
+                if not raw_docs:
+                    return
+                yield deque(queryset._hydrate_documents(raw_docs, read=True))
 
+        for batch in read_ahead(batches(), prefetch):
+            while batch:
+                yield batch.popleft()
 
-class LargeBinary(DynamicDocument):
-    '''
-    The ORM model for large binary.
+    def delete_with_binaries(self, batch_size=1000):
+        '''
+        delete the documents of the queryset with their binaries in bulk,
+        and returns the number of the deleted documents.
 
-    Since the mongodb restrict each object size exceed to 16MB.
-    The binary beyond 16MB should be stored using the GridFS feature.
-    This table model is for dealing with the binary larger than 16MB,
-    using the FileField in mongoengine.
+        The document ids are read per batch_size and deleted with their
+        LargeBinary entries and GridFS files with delete_many.
+        '''
+        clazz = self._document._wrapper
+        queryset = super(BinaryQuerySet, self).only('id')
+        ids = (doc['_id'] for doc in queryset._cursor)
+        deleted = 0
+        for batch in batched(ids, batch_size):
+            deleted += delete_documents(self._document, batch)
+            if clazz.identity_map is not None:
+                for pk in batch:
+                    clazz.identity_map.invalidate(pk)
+        return deleted
 
-    The detail description concerning the GridFS can be found in
+    def history(self, pk):
+        '''
+        returns the list of the versions of the document saved with snapshot,
+        as the dicts of the version number and the created time in the version order.
+        '''
+        return [
+            {'version': snapshot.version, 'created': snapshot.created}
+            for snapshot in Snapshot.objects(parent_id=pk).only('version', 'created').order_by('version')
+        ]
 
-    - GridFS supports in mongoengine: http://docs.mongoengine.org/guide/gridfs.html
-    - GridFS: https://docs.mongodb.org/manual/core/gridfs/
-    '''
-    parent_id = fields.ObjectIdField()
-    variable = fields.StringField()
-    archiver = fields.StringField()
-    binary = fields.FileField()
-    updated = fields.DateTimeField(default=None)
+    def projection(self):
+        '''
+        returns the projection of the binaries as the tuple of the names to load and to skip.
+        '''
+        return self._binary_only, self._binary_excludes
 
+    def __getitem__(self, key):
+        if not isinstance(key, (int, long)) or self._as_pymongo or self._scalar or self._none:
+            return super(BinaryQuerySet, self).__getitem__(key)
+        queryset = self.clone()
+        return self._hydrate_documents([queryset._cursor[key]])[0]
 
-class Archiver(object):
+    def rewind(self):
+        self._binary_buffer.clear()
+        return super(BinaryQuerySet, self).rewind()
+
+    def next(self):
+        if self._as_pymongo or self._scalar or self._none or self._limit == 0:
+            return super(BinaryQuerySet, self).next()
+        if not self._binary_buffer:
+            self._fill_binary_buffer()
+        if not self._binary_buffer:
+            raise StopIteration
+        return self._binary_buffer.popleft()
+
+    __next__ = next
+
+    def _fill_binary_buffer(self):
+        raw_docs = list(itertools.islice(self._cursor, self._binary_batch_size))
+        if raw_docs:
+            self._binary_buffer.extend(self._hydrate_documents(raw_docs))
+
+    def _hydrate_documents(self, raw_docs, read=None):
+        '''
+        returns the class instances hydrated from the raw documents,
+        fetching the binaries of all the documents with a single query.
+        '''
+        if read is None:
+            read = self._binary_read
+        clazz = self._document._wrapper
+        native = clazz.database(custom=False)
+        documents = [
+            native._from_son(
+                raw_doc,
+                _auto_dereference=self._auto_dereference,
+                only_fields=self.only_fields
+            )
+            for raw_doc in raw_docs
+        ]
+        projection = self.projection()
+        binaries = clazz.fetch_binaries(
+            clazz.unmapped([doc.pk for doc in documents]), read=read, projection=projection)
+        return [clazz.hydrate(doc, binaries.get(doc.pk), projection) for doc in documents]
+
+
+class Storage(object):
     '''
-    the superclass for archiving the mogoengine unsupporting variables in the class.
+    the superclass of the storage backends of the Base classes.
 
-    The child class of this class should have dump / restore methods
-    for handling the binary expression of the variable.
-    dump() method be also with post_dump decorator as well as
-    restore() method be with pre_restore decorator.
+    The child class should have the methods to connect the storage,
+    save an instance, query the instances of a class and drop them.
+    The features not supported by the backend raise NotImplementedError.
 
-    See PickleArchiver, NpyArchiver for more concrete example.
+    See MongoStorage, and LocalStorage in the local module for more concrete example.
     '''
     __metaclass__ = ABCMeta
 
+    def connect(self, clazz):
+        '''
+        prepare the storage for the class, which is called on each instantiation.
+        '''
+        pass
+
     @abstractmethod
-    def dump(self, obj):
+    def save(self, instance):
         '''
-        Accept any object as an argument and dump it into a file stream
+        save the current status of the instance and returns the list of the attribute names written.
         '''
         return None
 
     @abstractmethod
-    def restore(self, obj):
+    def objects(self, clazz):
         '''
-        Accept file stream and restore it as a input variable style.
+        returns the queryset of the instances of the class.
         '''
         return None
 
+    @abstractmethod
+    def native_objects(self, clazz):
+        '''
+        returns the queryset of the documents of the class without the binaries.
+        '''
+        return None
 
-class PickleArchiver(Archiver):
-    '''
-    The Archiver implementation with pickle format.
-    '''
-    def dump(self, obj):
-        bio = io.BytesIO()
-        pickle.dump(obj, bio)
-        return bio
+    def load(self, clazz, pk):
+        '''
+        returns the instance of the class of the document id.
+        '''
+        return self.objects(clazz).get(pk=pk)
 
-    def restore(self, fp):
-        return pickle.load(fp)
+    @abstractmethod
+    def drop(self, clazz, batch_size=1000):
+        '''
+        delete all the instances of the class with their binaries.
+        '''
+        return None
 
 
-class NpyArchiver(Archiver):
+class MongoStorage(Storage):
     '''
-    The Archiver implementation with npy format.
+    The Storage implementation with the mongodb and the GridFS, which is the default.
+
+    All the features of Base are supported on this storage.
     '''
-    def dump(self, obj):
-        bio = io.BytesIO()
-        numpy.save(bio, obj)
-        return bio
+    def connect(self, clazz):
+        connect_alias(clazz.db_alias)
 
-    def restore(self, fp):
-        return numpy.load(fp)
+    def save(self, instance):
+        return instance.store()
+
+    def objects(self, clazz):
+        connect_alias(clazz.db_alias)
+        return clazz.database().objects
+
+    def native_objects(self, clazz):
+        connect_alias(clazz.db_alias)
+        return clazz.database(False).objects
+
+    def drop(self, clazz, batch_size=1000):
+        connect_alias(clazz.db_alias)
+        if clazz.identity_map is not None:
+            clazz.identity_map.clear()
+        ids = (doc['_id'] for doc in clazz.database(custom=False)._get_collection().find({}, ['_id']))
+        for batch in batched(ids, batch_size):
+            purge_binaries({'parent_id': {'$in': batch}})
+            purge_snapshots({'parent_id': {'$in': batch}})
+        clazz.database().drop_collection()
 
 
 class Base(object):
     '''
     Base utility class to store its variables into the mongodb collection.
+
+    The variables are stored into the storage backend given as the storage class variable,
+    which is the mongodb (MongoStorage) by default.
     '''
     valid_classes = [int, float, long, bool, str, list, tuple, dict, datetime]
     default_excludes = [
         'valid_classes', 'default_excludes', 'default_archiver',
-        'excludes', 'archivers', 'objects', 'collection'
+        'excludes', 'archivers', 'objects', 'collection', 'deduplicate',
+        'workers', 'max_inflight_bytes', 'codecs', 'default_codec', 'chunks',
+        'array_cache', 'identity_map', 'inline_threshold', 'inline_budget', 'dbarchive_inline',
+        'db_alias', 'appends', 'snapshot_keyframe', 'storage'
     ]
     excludes = []
+    inline_threshold = 1 << 16
+    inline_budget = 1 << 23
+    array_cache = None
+    identity_map = None
+    chunks = {}
+    appends = {}
+    snapshot_keyframe = 10
+    storage = MongoStorage()
+    codecs = {}
+    default_codec = None
+    deduplicate = False
+    workers = 1
+    max_inflight_bytes = 1 << 30
+    db_alias = default_alias
 
     def __new__(cls, *args, **kwargs):
-        connect()
+        cls.storage.connect(cls)
         instance = super(Base, cls).__new__(cls)
         cls.excludes = deepcopy(cls.default_excludes)
         instance.default_archiver = PickleArchiver()
-        instance.archivers = {numpy.ndarray: NpyArchiver()}
+        instance.archivers = {}
         instance.collection = None
         return instance
 
+    def __getattr__(self, name):
+        '''
+        restore the binary attribute from the GridFS when it is accessed first time.
+
+        This method is called only when the normal attribute lookup failed,
+        so the attributes already restored are accessed without any overhead.
+        The binaries hidden by the class attributes of the same names are restored on hydration.
+        '''
+        lazies = self.__dict__.get('_lazies')
+        if not lazies or name not in lazies:
+            raise AttributeError(
+                "'{}' object has no attribute '{}'".format(type(self).__name__, name))
+        value = lazies[name].load()
+        del lazies[name]
+        self.__dict__[name] = value
+        self.refresh_identity()
+        return value
+
+    @instrumented('prefetch')
+    def prefetch(self, *names):
+        '''
+        restore the binary attributes not loaded yet at once.
+
+        All the pending binaries are restored if no name is specified.
+        The binaries are restored concurrently if workers is larger than 1.
+        '''
+        lazies = self.__dict__.get('_lazies') or {}
+        names = [name for name in (names or list(lazies)) if name in lazies]
+        values = self.pipeline().map(lambda name: lazies[name].load(), names)
+        for name, value in zip(names, values):
+            del lazies[name]
+            self.__dict__[name] = value
+        if names:
+            self.refresh_identity()
+        return self
+
+    def refresh_identity(self):
+        '''
+        update the size of the instance in identity_map after its binaries are restored.
+        '''
+        if self.identity_map is not None and self.collection is not None:
+            self.identity_map.refresh(self.collection.pk)
+
+    def pipeline(self):
+        '''
+        returns the pipeline for archiving / restoring the binaries of the instance.
+        '''
+        return Pipeline(self.workers, self.max_inflight_bytes)
+
     @classmethod
     def database(cls, custom=True):
         '''
         Dynamically define a child class of DynamicDocument based on the current class variable configuration.
+
+        The defined class is memoized per the class and custom,
+        so the table class is defined and registered to mongoengine only once.
         '''
+        cls.require_mongodb('the mongodb table')
+        table = _tables.get((cls, custom))
+        if table is not None:
+            return table
+
         def new(clazz, *args, **kwargs):
             '''
             custom development of __new__ for DynamicDocument.
@@ -153,87 +1493,562 @@ class Base(object):
             '''
             instance = super(DynamicDocument, clazz).__new__(clazz, *args, **kwargs)
             instance.__init__(*args, **kwargs)
-            members = inspect.getmembers(instance, lambda a: not(inspect.isroutine(a)))
-            attributes = [(k, v) for k, v in members if not k.startswith('_')]
-
-            wrapper_instance = cls.__new__(cls)
-            wrapper_instance.__init__()
-            wrapper_instance.collection = instance
+            only_fields = kwargs.get('__only_fields')
+            return cls.hydrate(instance, projection=(frozenset(only_fields) if only_fields else None, ()))
 
-            for k, v in attributes:
-                if k in cls.excludes:
-                    continue
-                wrapper_instance.__setattr__(k, v)
-
-            for binary in LargeBinary.objects.filter(parent_id=instance.pk).all():
-                # logging.debug('binary: {}'.format(binary.pk))
-                archiver = eval(binary.archiver)()
-                obj = archiver.restore(binary.binary)
-                wrapper_instance.__setattr__(binary.variable, obj)
-
-            return wrapper_instance
-
-        attributes = {}
+        attributes = {'meta': {'db_alias': cls.db_alias}}
         if custom:
             attributes['__new__'] = new
-        return type(
+            attributes['_wrapper'] = cls
+            attributes['meta']['queryset_class'] = BinaryQuerySet
+        table = type(
             cls.__name__ + "Table",
             (DynamicDocument, ),
             attributes
         )
+        _tables[(cls, custom)] = table
+        return table
+
+    @classmethod
+    @instrumented('hydrate')
+    def hydrate(cls, instance, binaries=None, projection=None):
+        '''
+        returns the class instance restored from the document of the table.
+
+        binaries is the list of LazyBinary already fetched for the document.
+        They are queried from LargeBinary if not specified.
+        projection is the tuple of the binary names to load (None for all) and to skip.
+        The instance of the projected document is not registered to identity_map.
+
+        The __init__ method of the class is not called in the restoration.
+        If the class needs some fixups after the restoration, such as the attributes
+        not stored in the mongodb, define __dbarchive_restore__ method with no argument.
+        It is called after all the attributes are restored.
+
+        If identity_map is given, the instance already restored for the document is reused.
+        '''
+        identity_map = cls.identity_map
+        if identity_map is not None:
+            cached = identity_map.get(instance.pk)
+            if cached is not None:
+                return cached
+
+        attributes = [
+            (k, v) for k, v in instance._data.items()
+            if k != 'id' and not k.startswith('_')
+        ]
+        if binaries is None:
+            binaries = cls.fetch_binaries([instance.pk], projection=projection)[instance.pk]
+        inline = instance._data.get('dbarchive_inline') or {}
+        binaries = list(binaries) + [
+            LazyBinary(InlineBinary(k, entry), io.BytesIO(entry['data']))
+            for k, entry in inline.items() if projected(k, projection)
+        ]
+        return cls.assemble(instance, attributes, binaries, unprojected(projection))
+
+    @classmethod
+    def assemble(cls, collection, attributes, binaries, mapped=True):
+        '''
+        returns the class instance of the document (collection) with the native attributes
+        and the list of LazyBinary, which is registered to identity_map if mapped is True.
+        '''
+        # __init__ is not called, so the state is restored into __dict__ directly.
+        wrapper_instance = cls.__new__(cls)
+        wrapper_instance.collection = collection
+        state = wrapper_instance.__dict__
+        for k, v in attributes:
+            if k in cls.excludes:
+                continue
+            state[k] = v
+
+        lazies = {}
+        digests = {}
+        appended = {}
+        for lazy in binaries:
+            # logging.debug('binary: {}'.format(lazy.variable))
+            state.pop(lazy.variable, None)
+            lazies[lazy.variable] = lazy
+            digests[lazy.variable] = lazy.digest
+            if getattr(lazy.binary, 'segments', None) is not None:
+                appended[lazy.variable] = (list(lazy.binary.shape), lazy.binary.dtype)
+        state['_lazies'] = lazies
+        state['_digests'] = digests
+        state['_appended'] = appended
+        # the class attributes of the same names would hide the lazy binaries from __getattr__
+        shadowed = [k for k in lazies if hasattr(cls, k)]
+        if shadowed:
+            wrapper_instance.prefetch(*shadowed)
+
+        restore = getattr(wrapper_instance, '__dbarchive_restore__', None)
+        if restore is not None:
+            restore()
+        if cls.identity_map is not None and mapped:
+            return cls.identity_map.put(collection.pk, wrapper_instance)
+        return wrapper_instance
+
+    @classmethod
+    def unmapped(cls, parent_ids):
+        '''
+        returns the document ids whose instances are not in the identity map.
+        '''
+        if cls.identity_map is None:
+            return parent_ids
+        return [pk for pk in parent_ids if pk not in cls.identity_map]
 
-    def save(self):
+    @classmethod
+    @instrumented('fetch_binaries')
+    def fetch_binaries(cls, parent_ids, read=False, projection=None):
+        '''
+        fetch the LargeBinary entries of the documents with a single query.
+
+        returns the dict of the document id to the list of LazyBinary.
+        The GridFS files are also read in bulk if read is True.
+        Only the binaries in the projection are fetched if it is given.
+        '''
+        query = LargeBinary.objects.filter(parent_id__in=parent_ids)
+        if projection is not None:
+            only, excludes = projection
+            if only is not None:
+                query = query.filter(variable__in=list(only - frozenset(excludes)))
+            elif excludes:
+                query = query.filter(variable__nin=list(excludes))
+        binaries = list(query)
+        cache = cls.array_cache
+        streams = {}
+        if read:
+            file_ids = [
+                b.binary.grid_id for b in binaries
+                if b.binary.grid_id is not None and
+                (cache is None or not cache.contains(cache_key(b)))
+            ]
+            if file_ids:
+                streams = read_files(file_ids, LargeBinary.binary.collection_name)
+        result = dict((parent_id, []) for parent_id in parent_ids)
+        for binary in binaries:
+            result.setdefault(binary.parent_id, []).append(
+                LazyBinary(binary, streams.get(binary.binary.grid_id), cache))
+        return result
+
+    @instrumented('save')
+    def save(self, snapshot=False):
         '''
         Create a collection of the current class variables and save the current status in the mongodb.
+
+        returns the list of the attribute names actually written.
+        The binaries whose archived content is not changed since the last load / save are skipped.
+        If snapshot is True, the saved status is also stored as a new version (see snapshot()),
+        where the archived streams of the binaries are kept until the version is stored.
+        '''
+        if not snapshot:
+            return self.storage.save(self)
+        self.require_mongodb('snapshot')
+        self.__dict__['_dumped'] = {}
+        try:
+            written = self.storage.save(self)
+            self.snapshot()
+        finally:
+            self.__dict__.pop('_dumped', None)
+        return written
+
+    @classmethod
+    def require_mongodb(cls, feature):
+        '''
+        raise NotImplementedError if the storage of the class is not the mongodb.
+        '''
+        if not isinstance(cls.storage, MongoStorage):
+            raise NotImplementedError('{} is supported only on MongoStorage'.format(feature))
+
+    def store(self):
         '''
+        save the current status in the mongodb without snapshot.
+        '''
+        self.require_mongodb('store')
         if self.collection is None:
             self.collection = self.create_collection()
-        else:
-            members = inspect.getmembers(self, lambda a: not(inspect.isroutine(a)))
-            attributes = [(k, v) for k, v in members if not k.startswith('_')]
-            # archivers = {}
-            binaries = {}
-            for k, v in attributes:
-                if k in self.excludes:
-                    continue
-                if type(v) in self.valid_classes:
-                    self.collection.__setattr__(k, v)
-                else:
-                    binaries[k] = v
-            self.update_binaries(binaries)
-            # self.collection.__setattr__('archivers', archivers)
+            natives, binaries = self.split_attributes()
+            return sorted(natives.keys() + binaries.keys())
+
+        if self.identity_map is not None:
+            self.identity_map.invalidate(self.collection.pk)
+        natives, binaries = self.split_attributes()
+        written = []
+        for k, v in natives.items():
+            if getattr(self.collection, k, None) != v:
+                self.collection.__setattr__(k, v)
+                written.append(k)
+        written.extend(self.update_binaries(binaries))
+        # self.collection.__setattr__('archivers', archivers)
         self.collection.save()
+        return sorted(written)
 
-    def create_collection(self):
+    @instrumented('snapshot')
+    def snapshot(self):
         '''
-        create mongodb collection ORM based on the current class variable configuration
+        store the current status as a new version of the document, and returns the version number.
+
+        The binaries changed from the previous version are stored as the delta against it,
+        and a binary is stored as a whole (keyframe) instead when its chain of the files
+        would reach snapshot_keyframe, so that a version is restored from less than
+        snapshot_keyframe files per binary.
+        The binaries not restored yet are compared with the previous version by their stored digests
+        without being restored, and the streams archived by save(snapshot=True) are reused
+        instead of archiving the binaries again.
+        The previous version is read only for the binaries stored as the delta.
         '''
-        self.collection = self.database(custom=False)()
-        members = inspect.getmembers(self, lambda a: not(inspect.isroutine(a)))
-        attributes = [(k, v) for k, v in members if not k.startswith('_')]
-        # archivers = {}
+        self.require_mongodb('snapshot')
+        if self.collection is None:
+            self.store()
+        natives, binaries = self.split_attributes()
+        dumped = self.__dict__.get('_dumped') or {}
+        appended = self.__dict__.get('_appended') or {}
+        pk = self.collection.pk
+        previous = Snapshot.objects(parent_id=pk).order_by('-version').first()
+        version = 1 if previous is None else previous.version + 1
+        olds = previous.binaries if previous is not None else {}
+
+        entries = {}
+        for k, lazy in list((self.__dict__.get('_lazies') or {}).items()):
+            old = olds.get(k)
+            # the digests of the chunked and appended binaries do not follow their contents
+            if (old is not None and lazy.digest is not None and old.get('stored') == lazy.digest and
+                    not lazy.binary.chunk_shape and k not in appended):
+                entries[k] = old
+            else:
+                binaries[k] = getattr(self, k)
+
+        changed = {}
+        for k, v in binaries.items():
+            old = olds.get(k)
+            if k in dumped:
+                archiver, fp, stored = dumped[k]
+                if old is not None and old.get('stored') == stored:
+                    entries[k] = old
+                    continue
+                if isinstance(archiver, CompressedArchiver):
+                    fp = archiver.codec.decompress(fp)
+                    archiver = archiver.archiver
+            else:
+                if isinstance(v, ChunkedArray):
+                    v = v[...]
+                archiver = self.archiver_for(v)
+                fp = archiver.dump(v)
+                stored = None
+            fp.seek(0)
+            raw = fp.read()
+            digest = hashlib.sha1(raw).hexdigest()
+            if old is not None and old['digest'] == digest:
+                entries[k] = dict(old, stored=stored or old.get('stored'))
+                continue
+            entry = describe_archiver(archiver)
+            entry['digest'] = digest
+            entry['stored'] = stored
+            changed[k] = (entry, raw)
+
+        deltas = [
+            k for k, (entry, _) in changed.items()
+            if k in olds and olds[k]['archiver'] == entry['archiver'] and
+            len(olds[k]['chain']) + 1 < self.snapshot_keyframe
+        ]
+        bases = restore_snapshot(previous, deltas) if deltas else {}
+        codec = ZlibCodec()
+        pending = []
+        for k, (entry, raw) in changed.items():
+            if k in bases:
+                entry['chain'] = list(olds[k]['chain'])
+                data = xor_bytes(raw, bases[k])
+            else:
+                entry['chain'] = []
+                data = raw
+            pending.append((k, entry, codec.compress(io.BytesIO(data))))
+
+        file_ids = write_files([fp for _, _, fp in pending], LargeBinary.binary.collection_name)
+        for (k, entry, _), file_id in zip(pending, file_ids):
+            entry['chain'].append(file_id)
+            entries[k] = entry
+        Snapshot(
+            parent_id=pk, version=version, created=datetime.now(),
+            natives=natives, binaries=entries
+        ).save()
+        return version
+
+    @classmethod
+    def load(cls, pk, version=None):
+        '''
+        load the instance of the document id, or its version saved with snapshot.
+
+        The instance of a version is restored with all the binaries,
+        and it overwrites the current document when it is saved.
+        '''
+        if version is None:
+            return cls.storage.load(cls, pk)
+        cls.require_mongodb('load with version')
+        connect_alias(cls.db_alias)
+        snapshot = Snapshot.objects(parent_id=pk, version=version).first()
+        if snapshot is None:
+            raise ValueError('no version {} of the document: {}'.format(version, pk))
+        raws = restore_snapshot(snapshot)
+        instance = cls.__new__(cls)
+        instance.collection = cls.database(custom=False).objects(pk=pk).first()
+        state = instance.__dict__
+        state.update(snapshot.natives)
+        for k, entry in snapshot.binaries.items():
+            archiver = registry.get(entry['archiver'], entry.get('archiver_version'))
+            state[k] = archiver.restore(io.BytesIO(raws[k]))
+        restore = getattr(instance, '__dbarchive_restore__', None)
+        if restore is not None:
+            restore()
+        return instance
+
+    @instrumented('split_attributes')
+    def split_attributes(self):
+        '''
+        returns the attributes to be stored as the tuple of the natives and the binaries.
+
+        The natives are stored in the document directly,
+        while the binaries are archived into the GridFS.
+        The binaries not restored yet are not included since they are not changed.
+        '''
+        natives = {}
         binaries = {}
-        for k, v in attributes:
-            if k in self.excludes:
+        lazies = self.__dict__.get('_lazies') or {}
+        for k in self.attribute_plan():
+            if k in lazies:
+                continue
+            v = getattr(self, k)
+            if inspect.isroutine(v):
                 continue
             if type(v) in self.valid_classes:
-                logging.debug("set attribute default: {}, {}".format(k, type(v)))
-                self.collection.__setattr__(k, v)
+                natives[k] = v
             else:
                 binaries[k] = v
+        return natives, binaries
+
+    def attribute_plan(self):
+        '''
+        returns the sorted names of the attributes to be stored.
+
+        The plan is compiled per class and the attribute sets of the instance and the class,
+        and it is compiled again only when the attribute sets or the excludes are changed,
+        instead of walking all the members with inspect.getmembers on every save.
+        '''
+        cls = type(self)
+        members = frozenset(
+            k for clazz in cls.__mro__ for k in vars(clazz) if not k.startswith('_'))
+        key = (
+            frozenset(k for k in self.__dict__ if not k.startswith('_')),
+            members,
+            tuple(self.excludes)
+        )
+        # the plans are kept per class in LRU order, up to _plan_size attribute sets.
+        plans = _plans.setdefault(cls, OrderedDict())
+        plan = plans.pop(key, None)
+        if plan is None:
+            names = key[0] | frozenset(k for k in members if not inspect.isroutine(getattr(cls, k)))
+            plan = sorted(k for k in names if k not in self.excludes)
+            if len(plans) >= _plan_size:
+                plans.popitem(last=False)
+        plans[key] = plan
+        return plan
+
+    @instrumented('create_collection')
+    def create_collection(self):
+        '''
+        create mongodb collection ORM based on the current class variable configuration
+        '''
+        self.collection = self.database(custom=False)()
+        natives, binaries = self.split_attributes()
+        for k, v in natives.items():
+            logging.debug("set attribute default: {}, {}".format(k, type(v)))
+            self.collection.__setattr__(k, v)
         # self.collection.__setattr__('archivers', archivers)
-        self.collection.save()
+        # the id is assigned in advance, so that the inline binaries are inserted at once.
+        self.collection.pk = ObjectId()
         self.update_binaries(binaries)
+        self.collection.save(force_insert=True)
         return self.collection
 
+    @instrumented('update_binaries')
     def update_binaries(self, binaries):
+        '''
+        archive the binaries into the GridFS.
+
+        The digest of the archived content is compared with the one recorded at the last load / save,
+        and the binary is uploaded only if it is changed.
+        If workers is larger than 1, the archiving of a binary overlaps with the upload of the others.
+        The arrays configured in chunks are stored in chunks, rewriting only the chunks changed.
+        The arrays configured in appends are stored appending only the rows added as a segment.
+        The binaries archived into inline_threshold bytes or less are embedded in the document
+        instead of the GridFS, and the document should be saved after this call.
+        returns the list of the variable names actually written.
+        '''
+        binaries, appended = self.split_appended(binaries)
+        binaries, chunked = self.split_chunked(binaries)
+        original = self.inline_binaries()
+        inline = dict(original)
+        written = [k for k, v in chunked.items() if self.write_chunked(k, v)]
+        for k in chunked:
+            inline.pop(k, None)
+        # the arrays embedded in the document are moved to the GridFS as a whole
+        for k, v in appended.items():
+            if self.write_appended(k, v, whole=k in original):
+                written.append(k)
+                inline.pop(k, None)
+
+        def update(item):
+            entry = self.dump_binary(*item)
+            if entry is None:
+                return None
+            if not self.place_binary(entry, inline):
+                self.write_binary(*entry)
+            return entry[0]
+
+        stored = set(self.__dict__.get('_digests') or {})
+        items = list(binaries.items())
+        updated = self.pipeline().map(update, items, [getattr(v, 'nbytes', 0) for k, v in items])
+        delete_binaries(
+            (self.collection.pk, k) for k in inline if k in stored and k not in original)
+        if inline != original:
+            self.collection.dbarchive_inline = inline
+        return written + [k for k in updated if k is not None]
+
+    def inline_binaries(self):
+        '''
+        returns the copy of the dict of the binaries embedded in the document.
+        '''
+        return dict(getattr(self.collection, 'dbarchive_inline', None) or {})
+
+    def place_binary(self, entry, inline):
+        '''
+        embed the archived binary into the inline dict if it is small enough
+        and the inline binaries stay within inline_budget bytes in total,
+        or remove it from the dict to be uploaded into the GridFS.
+        returns True if the binary is embedded.
+        '''
+        k, archiver, fp, digest = entry
+        size = stream_size(fp)
+        with _inline_lock:
+            # the binaries are placed concurrently by the pipeline workers
+            total = sum(len(v['data']) for name, v in inline.items() if name != k)
+            if size > self.inline_threshold or total + size > self.inline_budget:
+                inline.pop(k, None)
+                return False
+            data = describe_archiver(archiver)
+            data['digest'] = digest
+            data['data'] = Binary(fp.read())
+            inline[k] = data
+        self.__dict__.setdefault('_digests', {})[k] = digest
+        return True
+
+    def split_chunked(self, binaries):
+        '''
+        returns the tuple of the binaries and the arrays to be stored in chunks.
+        '''
+        others = {}
+        chunked = {}
+        for k, v in binaries.items():
+            if isinstance(v, ChunkedArray) or (k in self.chunks and isinstance(v, numpy.ndarray)):
+                chunked[k] = v
+            else:
+                others[k] = v
+        return others, chunked
+
+    def split_appended(self, binaries):
+        '''
+        returns the tuple of the binaries and the arrays to be stored by appending.
+        '''
+        others = {}
+        appended = {}
         for k, v in binaries.items():
+            if k in self.appends and isinstance(v, numpy.ndarray) and v.ndim > 0 and not v.dtype.hasobject:
+                appended[k] = v
+            else:
+                others[k] = v
+        return others, appended
+
+    def write_appended(self, k, v, whole=False):
+        '''
+        store the array appending the rows added since the last load / save, and returns True if written.
+
+        The rows already stored are assumed not to be changed, and only the added rows
+        are uploaded as a segment of the LargeBinary entry.
+        The whole array is stored again if its dtype or the shape of its rows is changed,
+        it gets shorter, or the number of the segments exceeds appends[k] (compaction).
+        The segments are never compacted if appends[k] is None.
+        If whole is True, the whole array is stored even if it is not changed,
+        e.g. it is embedded in the document yet.
+        '''
+        appended = self.__dict__.setdefault('_appended', {})
+        stored = appended.get(k)
+        if stored is not None and not whole:
+            shape, dtype = stored
+            if dtype == v.dtype.str and list(shape[1:]) == list(v.shape[1:]) and len(v) >= shape[0]:
+                if len(v) == shape[0]:
+                    return False
+                segments = self.append_segment(k, v, shape[0])
+                appended[k] = (list(v.shape), v.dtype.str)
+                if self.appends[k] is None or segments <= self.appends[k]:
+                    return True
+                logging.debug('compacting the segments: {}'.format(k))
+
+        entry = self.dump_binary(k, v, force=whole)
+        if entry is not None:
+            self.write_binary(*entry)
+            LargeBinary._get_collection().update_one(
+                {'parent_id': self.collection.pk, 'variable': k},
+                {'$set': {'shape': list(v.shape), 'dtype': v.dtype.str, 'segments': []}}
+            )
+        appended[k] = (list(v.shape), v.dtype.str)
+        return entry is not None
+
+    def append_segment(self, k, v, offset):
+        '''
+        upload the rows of the array from offset as a segment, and returns the number of the segments.
+        '''
+        with instrumentation.measure('append', type(self).__name__, k) as record:
+            fp = NpyArchiver().dump(numpy.ascontiguousarray(v[offset:]))
+            if record:
+                record.bytes = stream_size(fp)
+            file_id = write_files([fp], LargeBinary.binary.collection_name)[0]
+            binary = LargeBinary._get_collection().find_one_and_update(
+                {'parent_id': self.collection.pk, 'variable': k},
+                {
+                    '$push': {'segments': {'file': file_id, 'rows': len(v) - offset}},
+                    '$set': {'shape': list(v.shape), 'updated': datetime.now()}
+                },
+                projection=['segments'],
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+        return len(binary['segments'])
+
+    def write_chunked(self, k, v):
+        '''
+        store the array in chunks, and returns True if any chunk is written.
+
+        The handle restored for the variable itself is skipped,
+        since the regions assigned to it are written immediately.
+        '''
+        if isinstance(v, ChunkedArray):
+            if v.binary.parent_id == self.collection.pk and v.binary.variable == k:
+                return False
+            chunk_shape = self.chunks.get(k, v.chunk_shape)
+            v = v[...]
+        else:
+            chunk_shape = self.chunks[k]
+        return bool(ChunkedArray.store(self.collection.pk, k, v, chunk_shape).written)
+
+    def write_binary(self, k, archiver, fp, digest):
+        '''
+        upload the archived binary into the GridFS.
+        '''
+        with instrumentation.measure('write_binary', type(self).__name__, k) as record:
+            if record:
+                record.bytes = stream_size(fp)
             binary = LargeBinary.objects(
                 parent_id=self.collection.pk, variable=k
             ).modify(
                 upsert=True, new=True,
                 set__parent_id=self.collection.pk,
-                set_variable=k
+                set__variable=k
             )
             if not binary.updated is None:
                 '''
@@ -245,36 +2060,261 @@ class Base(object):
                 * http://docs.mongoengine.org/guide/gridfs.html
                 '''
                 logging.debug('updaring binary')
-                binary.binary.delete()
+                release_binary(binary)
 
-            if type(v) in self.archivers:
-                archiver = self.archivers[type(v)]
-                fp = archiver.dump(v)
-                fp.seek(0)
-                binary.binary.put(fp)
-                binary.archiver = archiver.__class__.__name__
-                binary.updated = datetime.now()
-                binary.save()
+            if self.deduplicate:
+                blob = Blob.acquire(digest, fp)
+                binary.binary = fields.GridFSProxy(
+                    grid_id=blob.binary.grid_id,
+                    collection_name=blob.binary.collection_name
+                )
             else:
-                archiver = self.default_archiver
-                fp = archiver.dump(v)
                 fp.seek(0)
                 binary.binary.put(fp)
-                binary.archiver = archiver.__class__.__name__
-                binary.updated = datetime.now()
-                binary.save()
+            binary.deduplicated = self.deduplicate
+            for name, value in describe_archiver(archiver).items():
+                setattr(binary, name, value)
+            binary.digest = digest
+            binary.updated = datetime.now()
+            binary.save()
+            self.__dict__.setdefault('_digests', {})[k] = digest
+
+    def dump_binaries(self, binaries):
+        '''
+        archive the binaries and returns the list of (name, archiver, file stream, digest)
+        only for the binaries changed since the last load / save.
+        '''
+        items = list(binaries.items())
+        dumped = self.pipeline().map(
+            lambda item: self.dump_binary(*item), items,
+            [getattr(v, 'nbytes', 0) for k, v in items]
+        )
+        return [entry for entry in dumped if entry is not None]
+
+    def archiver_for(self, v):
+        '''
+        returns the archiver of the variable, dispatched by the MRO of its type.
+
+        The archivers of the instance take precedence over the registered ones,
+        and the default archiver is used if no archiver is found.
+        '''
+        for clazz in type(v).__mro__:
+            if clazz in self.archivers:
+                return self.archivers[clazz]
+        archiver = registry.lookup(type(v))
+        return self.default_archiver if archiver is None else archiver
+
+    def dump_binary(self, k, v, force=False):
+        '''
+        archive the binary and returns (name, archiver, file stream, digest),
+        or None if it is not changed since the last load / save unless force is True.
+        '''
+        archiver = self.archiver_for(v)
+        codec = self.codecs.get(k, self.codecs.get(type(v), self.default_codec))
+        if codec is not None:
+            if codec.shuffle and type(archiver) is NpyArchiver:
+                archiver = ShuffleNpyArchiver()
+            archiver = CompressedArchiver(archiver, codec)
+        with instrumentation.measure('dump', type(self).__name__, k) as record:
+            fp = archiver.dump(v)
+            if record:
+                record.bytes = stream_size(fp)
+                record.raw_bytes = record.raw_bytes or record.bytes
+        digest = digest_of(fp)
+        dumped = self.__dict__.get('_dumped')
+        if dumped is not None:
+            # reused by snapshot() of save(snapshot=True)
+            dumped[k] = (archiver, fp, digest)
+        if not force and (self.__dict__.get('_digests') or {}).get(k) == digest:
+            logging.debug('binary is not changed: {}'.format(k))
+            return None
+        return k, archiver, fp, digest
+
+    @classmethod
+    @instrumented('save_many')
+    def save_many(cls, instances, batch_size=1000):
+        '''
+        save the instances of the class in bulk.
+
+        The documents of each batch are written with insert_many / bulk_write,
+        and their binaries are written into the GridFS with bulk inserts.
+        The inserted documents are assigned to the collection of each instance.
+        returns the list of the attribute names written per instance.
+        '''
+        cls.require_mongodb('save_many')
+        connect_alias(cls.db_alias)
+        table = cls.database(custom=False)
+        written = []
+        for i in xrange(0, len(instances), batch_size):
+            batch = instances[i:i + batch_size]
+            written.extend(cls._save_batch(table, batch))
+        return written
+
+    @classmethod
+    def _save_batch(cls, table, batch):
+        collection = table._get_collection()
+        written = []
+        created = []
+        updates = []
+        dumped = []
+        chunked = []
+        removed = []
+        for instance in batch:
+            if cls.identity_map is not None and instance.collection is not None:
+                cls.identity_map.invalidate(instance.collection.pk)
+            natives, binaries = instance.split_attributes()
+            binaries, appends = instance.split_appended(binaries)
+            binaries, arrays = instance.split_chunked(binaries)
+            stored = set(instance.__dict__.get('_digests') or {})
+            entries = instance.dump_binaries(binaries)
+            original = instance.inline_binaries()
+            inline = dict(original)
+            for k in itertools.chain(arrays, appends):
+                inline.pop(k, None)
+            # the appended arrays embedded in the document are moved to the GridFS as a whole
+            chunked.append((instance, arrays, dict((k, (v, k in original)) for k, v in appends.items())))
+            large = [entry for entry in entries if not instance.place_binary(entry, inline)]
+            dumped.append((instance, large))
+
+            if instance.collection is None:
+                instance.collection = table()
+                for k, v in natives.items():
+                    instance.collection.__setattr__(k, v)
+                if inline:
+                    instance.collection.dbarchive_inline = inline
+                created.append(instance)
+                names = natives.keys()
+            else:
+                changed = dict(
+                    (k, v) for k, v in natives.items()
+                    if getattr(instance.collection, k, None) != v
+                )
+                for k, v in changed.items():
+                    instance.collection.__setattr__(k, v)
+                names = changed.keys()
+                if inline != original:
+                    instance.collection.dbarchive_inline = inline
+                    changed['dbarchive_inline'] = inline
+                if changed:
+                    updates.append(pymongo.UpdateOne(
+                        {'_id': instance.collection.pk}, {'$set': changed}))
+                removed.extend(
+                    (instance.collection.pk, k) for k in inline
+                    if k in stored and k not in original)
+            written.append(sorted(names + [k for k, _, _, _ in entries]))
+
+        if created:
+            result = collection.insert_many([ins.collection.to_mongo() for ins in created])
+            for instance, pk in zip(created, result.inserted_ids):
+                instance.collection.pk = pk
+        if updates:
+            collection.bulk_write(updates, ordered=False)
+        for instance in batch:
+            instance.collection._clear_changed_fields()
+            instance.collection._created = False
+
+        cls._write_binaries(dumped)
+        delete_binaries(removed)
+        for names, (instance, arrays, appends) in zip(written, chunked):
+            names.extend(k for k, v in arrays.items() if instance.write_chunked(k, v))
+            names.extend(
+                k for k, (v, whole) in appends.items() if instance.write_appended(k, v, whole))
+            names.sort()
+        return written
+
+    @classmethod
+    def _write_binaries(cls, dumped):
+        parent_ids = [instance.collection.pk for instance, entries in dumped if entries]
+        if not parent_ids:
+            return
+        olds = {}
+        for binary in LargeBinary.objects.filter(parent_id__in=parent_ids):
+            olds[(binary.parent_id, binary.variable)] = binary
+
+        released = []
+        streams = []
+        for instance, entries in dumped:
+            for k, archiver, fp, digest in entries:
+                old = olds.get((instance.collection.pk, k))
+                if old is not None and old.updated is not None:
+                    if old.segments:
+                        released.extend(segment['file'] for segment in old.segments)
+                    if old.chunk_shape:
+                        released.extend(old.chunk_files.values())
+                    elif old.deduplicated:
+                        Blob.release(old.digest)
+                    elif old.binary.grid_id is not None:
+                        released.append(old.binary.grid_id)
+                if not cls.deduplicate:
+                    streams.append(fp)
+        delete_files(released, LargeBinary.binary.collection_name)
+        file_ids = iter(write_files(streams, LargeBinary.binary.collection_name))
+
+        operations = []
+        for instance, entries in dumped:
+            digests = instance.__dict__.setdefault('_digests', {})
+            for k, archiver, fp, digest in entries:
+                if cls.deduplicate:
+                    file_id = Blob.acquire(digest, fp).binary.grid_id
+                else:
+                    file_id = next(file_ids)
+                update = {
+                    'parent_id': instance.collection.pk,
+                    'variable': k,
+                    'binary': file_id,
+                    'shape': None,
+                    'dtype': None,
+                    'chunk_shape': None,
+                    'chunk_files': {},
+                    'chunk_digests': {},
+                    'segments': None,
+                    'digest': digest,
+                    'deduplicated': cls.deduplicate,
+                    'updated': datetime.now()
+                }
+                update.update(describe_archiver(archiver))
+                operations.append(pymongo.UpdateOne(
+                    {'parent_id': instance.collection.pk, 'variable': k},
+                    {'$set': update},
+                    upsert=True
+                ))
+                digests[k] = digest
+                # the arrays configured in appends are stored again as a whole on the next save
+                instance.__dict__.get('_appended', {}).pop(k, None)
+        LargeBinary._get_collection().bulk_write(operations, ordered=False)
+
+    @classmethod
+    @instrumented('bulk_load')
+    def bulk_load(cls, ids, read=False):
+        '''
+        load the instances of the given document ids in bulk.
+
+        The documents and their LargeBinary entries are fetched with a single query each,
+        as well as the GridFS files if read is True.
+        returns the list of the instances in the order of ids, None for the ids not found.
+        '''
+        cls.require_mongodb('bulk_load')
+        connect_alias(cls.db_alias)
+        ids = list(ids)
+        documents = dict(
+            (doc.pk, doc) for doc in cls.database(custom=False).objects.filter(pk__in=ids)
+        )
+        binaries = cls.fetch_binaries(cls.unmapped(list(documents.keys())), read=read)
+        return [
+            cls.hydrate(documents[pk], binaries.get(pk)) if pk in documents else None
+            for pk in ids
+        ]
 
     @classmethod
-    def drop_collection(cls):
+    @instrumented('drop_collection')
+    def drop_collection(cls, batch_size=1000):
         '''
         drop collection representing the class from mongodb
+
+        The binaries of the documents are deleted per batch_size documents
+        with delete_many, instead of deleting them one by one.
         '''
-        connect()
-        for obj in cls.database(custom=False).objects.all():
-            for binary in LargeBinary.objects.filter(parent_id=obj.pk).all():
-                binary.binary.delete()
-                binary.delete()
-        cls.database().drop_collection()
+        cls.storage.drop(cls, batch_size)
 
     class __metaclass__(type):
         @property
@@ -282,16 +2322,14 @@ class Base(object):
             '''
             The queryset instance for quering the mongodb.
             '''
-            connect()
-            return cls.database().objects
+            return cls.storage.objects(cls)
 
         @property
         def native_objects(cls):
             '''
             The queryset instance for quering the mongodb.
             '''
-            connect()
-            return cls.database(False).objects
+            return cls.storage.native_objects(cls)
 
 
 if __name__ == '__main__':
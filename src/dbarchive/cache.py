@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Cache module for keeping the restored arrays on the local disk
+'''
+
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import numpy
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class ArrayCache(object):
+    '''
+    The local on-disk cache of the restored arrays.
+
+    The arrays are stored in the directory with the npy format,
+    and returned as the numpy.memmap of the cached file,
+    read-only (mode='r') or copy-on-write (mode='c').
+
+    The cached files are written into a temporary file and renamed atomically,
+    so that multiple processes can share the directory safely.
+    If max_bytes is given, the least recently used files are evicted
+    while the total size exceeds it.
+    '''
+    def __init__(self, directory, max_bytes=None, mode='r'):
+        if mode not in ('r', 'c'):
+            raise ValueError("mode must be 'r' or 'c': {}".format(mode))
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mode = mode
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        '''
+        returns the memmap of the cached array, or None if it is not cached.
+        '''
+        path = self.path(key)
+        try:
+            array = numpy.load(path, mmap_mode=self.mode)
+        except (IOError, OSError, ValueError):
+            return None
+        self.touch(path)
+        return array
+
+    def put(self, key, array):
+        '''
+        cache the array and returns its memmap.
+
+        The array itself is returned if it cannot be cached.
+        '''
+        if self.max_bytes is not None and array.nbytes > self.max_bytes:
+            return array
+        with self.create(key) as fp:
+            numpy.save(fp, array)
+        cached = self.get(key)
+        return array if cached is None else cached
+
+    def put_stream(self, key, stream, chunk_size=1 << 22):
+        '''
+        cache the npy file stream as it is and returns its memmap.
+
+        None is returned if the stream cannot be memory-mapped, e.g. the array of object dtype.
+        '''
+        with self.create(key) as fp:
+            shutil.copyfileobj(stream, fp, chunk_size)
+        path = self.path(key)
+        try:
+            array = numpy.load(path, mmap_mode=self.mode)
+        except ValueError:
+            self.remove(path)
+            return None
+        except (IOError, OSError):
+            return None
+        return array
+
+    @contextmanager
+    def create(self, key):
+        '''
+        yields the file object to write the cached file, which is renamed into the key on exit.
+        '''
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                yield fp
+            os.rename(temp, self.path(key))
+        except:
+            self.remove(temp)
+            raise
+        self.evict()
+
+    def touch(self, path):
+        '''
+        update the modification time of the file, which is used as the last access time in LRU.
+        '''
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        '''
+        remove the least recently used files while the total size exceeds max_bytes.
+        '''
+        if self.max_bytes is None:
+            return
+        with self.lock():
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.npy'):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self.remove(path)
+                total -= size
+
+    @contextmanager
+    def lock(self):
+        '''
+        lock the cache directory among the processes during the eviction.
+        '''
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, '.lock'), 'w') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
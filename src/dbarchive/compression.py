@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Compression module for the codecs applied to the archived binaries
+'''
+
+import io
+import bz2
+import zlib
+from abc import ABCMeta
+from abc import abstractmethod
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+chunk_size = 1 << 20
+# the bytes kept before the position of DecompressStream for the backward seeks
+seek_window = 1 << 16
+
+
+class Codec(object):
+    '''
+    the superclass of the compression codecs.
+
+    The child class should have the name recorded on LargeBinary,
+    and compressor / decompressor methods returning the incremental
+    compressor / decompressor objects of the codec.
+
+    If shuffle is True, the numeric arrays are archived with the byte-shuffle filter
+    before the compression.
+    '''
+    __metaclass__ = ABCMeta
+    name = None
+
+    def __init__(self, level=None, shuffle=False):
+        self.level = level
+        self.shuffle = shuffle
+
+    @abstractmethod
+    def compressor(self):
+        '''
+        returns the incremental compressor object with compress() and flush().
+        '''
+        return None
+
+    @abstractmethod
+    def decompressor(self):
+        '''
+        returns the incremental decompressor object with decompress().
+        '''
+        return None
+
+    def compress(self, fp):
+        '''
+        compress the file stream chunk by chunk and returns the compressed stream.
+        '''
+        compressor = self.compressor()
+        bio = io.BytesIO()
+        fp.seek(0)
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            bio.write(compressor.compress(chunk))
+        bio.write(compressor.flush())
+        bio.seek(0)
+        return bio
+
+    def decompress(self, fp):
+        '''
+        returns the stream decompressing the file stream on read.
+        '''
+        return DecompressStream(fp, self)
+
+
+class ZlibCodec(Codec):
+    '''
+    The Codec implementation with zlib.
+    '''
+    name = 'zlib'
+
+    def compressor(self):
+        return zlib.compressobj(6 if self.level is None else self.level)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+class Bz2Codec(Codec):
+    '''
+    The Codec implementation with bz2.
+    '''
+    name = 'bz2'
+
+    def compressor(self):
+        return bz2.BZ2Compressor(9 if self.level is None else self.level)
+
+    def decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+class LzmaCodec(Codec):
+    '''
+    The Codec implementation with lzma (xz).
+
+    On python 2, the backports.lzma package is required.
+    '''
+    name = 'lzma'
+
+    def __init__(self, level=None, shuffle=False):
+        if lzma is None:
+            raise ImportError('lzma is not available. install backports.lzma on python 2.')
+        super(LzmaCodec, self).__init__(level, shuffle)
+
+    def compressor(self):
+        return lzma.LZMACompressor(preset=self.level)
+
+    def decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+available_codecs = dict((codec.name, codec) for codec in [ZlibCodec, Bz2Codec, LzmaCodec])
+
+
+def get_codec(name):
+    '''
+    returns the codec instance of the name recorded on LargeBinary.
+    '''
+    if name not in available_codecs:
+        raise ValueError('unknown codec: {}'.format(name))
+    return available_codecs[name]()
+
+
+class DecompressStream(object):
+    '''
+    The readable stream decompressing the compressed file stream chunk by chunk.
+
+    The stream can be seeked forward, and backward within the last seek_window bytes
+    already read (e.g. numpy.load peeking the magic), or to the head by decompressing again.
+    Seeking from the end is not supported.
+    '''
+    def __init__(self, fp, codec):
+        self.fp = fp
+        self.codec = codec
+        self.rewind()
+
+    def rewind(self):
+        self.fp.seek(0)
+        self.decompressor = self.codec.decompressor()
+        self.buffer = b''
+        self.start = 0
+        self.offset = 0
+        self.position = 0
+        self.eof = False
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence != 0:
+            raise IOError('the decompressing stream cannot be seeked from the end')
+        if offset < 0:
+            raise IOError('invalid seek position: {}'.format(offset))
+        if offset < self.start:
+            self.rewind()
+        if offset <= self.start + len(self.buffer):
+            self.offset = offset - self.start
+            self.position = offset
+        while self.position < offset:
+            if not self.read(min(chunk_size, offset - self.position)):
+                break
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def fill(self, size):
+        '''
+        decompress the chunks until size bytes are buffered after the current position
+        or the stream ends, keeping seek_window bytes before the position.
+        '''
+        keep = max(0, self.offset - seek_window)
+        chunks = [self.buffer[keep:]]
+        self.start += keep
+        self.offset -= keep
+        length = len(chunks[0]) - self.offset
+        while (size < 0 or length < size) and not self.eof:
+            data = self.fp.read(chunk_size)
+            if data:
+                data = self.decompressor.decompress(data)
+            else:
+                self.eof = True
+                flush = getattr(self.decompressor, 'flush', None)
+                data = flush() if flush is not None else b''
+            chunks.append(data)
+            length += len(data)
+        self.buffer = b''.join(chunks)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self.fill(-1)
+            size = len(self.buffer) - self.offset
+        elif len(self.buffer) - self.offset < size:
+            self.fill(size)
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        self.position += len(data)
+        return data
+
+    def readline(self):
+        while True:
+            index = self.buffer.find(b'\n', self.offset)
+            if index >= 0 or self.eof:
+                break
+            self.fill(len(self.buffer) - self.offset + chunk_size)
+        end = len(self.buffer) if index < 0 else index + 1
+        return self.read(end - self.offset)
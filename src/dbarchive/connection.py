@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Connection module for managing the mongodb clients per alias
+'''
+
+import os
+import threading
+
+import mongoengine
+from mongoengine import connection as mongoengine_connection
+
+default_alias = mongoengine_connection.DEFAULT_CONNECTION_NAME
+default_database = '__py_dbarchive'
+
+
+class ConnectionManager(object):
+    '''
+    The manager of the mongodb clients per alias.
+
+    The client of an alias is created lazily on its first use and reused afterwards,
+    so that its connection pool is shared among the threads of the process.
+    The settings of an alias are passed to pymongo.MongoClient,
+    such as maxPoolSize, serverSelectionTimeoutMS and w (the write concern).
+
+    The clients inherited from the parent process by os.fork() are discarded
+    without being closed, and created again in the child process on its first use,
+    so that the processes never share the sockets.
+    The listeners are called with the alias whenever its client is (re)created.
+    '''
+    def __init__(self):
+        self.settings = {}
+        self.connected = set()
+        self.listeners = []
+        self.pid = os.getpid()
+        self.lock = threading.RLock()
+
+    def configure(self, alias=default_alias, database=default_database, **kwargs):
+        '''
+        set the database and the client settings of the alias.
+
+        The client of the alias is created again if the settings are changed.
+        '''
+        # the client connects on its first operation, which is safe to be forked before it.
+        kwargs.setdefault('connect', False)
+        with self.lock:
+            if self.settings.get(alias) == (database, kwargs):
+                return
+            self.disconnect(alias)
+            self.settings[alias] = (database, kwargs)
+
+    def connect(self, alias=default_alias):
+        '''
+        create the client of the alias if it is not created in this process yet.
+
+        This is a cheap no-op check once the client is created.
+        The default alias is configured with the default settings if it is not configured.
+        '''
+        if alias in self.connected and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            if alias in self.connected:
+                return
+            if alias not in self.settings:
+                if alias != default_alias:
+                    raise ValueError('the connection alias is not configured: {}'.format(alias))
+                self.configure(alias)
+            database, kwargs = self.settings[alias]
+            mongoengine.register_connection(alias, database, **kwargs)
+            mongoengine_connection.get_db(alias)
+            self.connected.add(alias)
+            for listener in self.listeners:
+                listener(alias)
+
+    def databases(self):
+        '''
+        returns the dict of the configured aliases (and the default alias) to their pymongo databases.
+        '''
+        with self.lock:
+            aliases = set(self.settings) | set([default_alias])
+        databases = {}
+        for alias in aliases:
+            self.connect(alias)
+            databases[alias] = mongoengine_connection.get_db(alias)
+        return databases
+
+    def disconnect(self, alias=default_alias):
+        '''
+        close the client of the alias, which is created again on the next use.
+        '''
+        with self.lock:
+            if alias in self.connected:
+                mongoengine_connection.disconnect(alias)
+                self.connected.discard(alias)
+
+    def reset(self):
+        '''
+        discard the clients inherited from the parent process.
+
+        They are not closed, since closing them would affect the sockets of the parent process.
+        '''
+        for alias in self.connected:
+            mongoengine_connection._connections.pop(alias, None)
+            mongoengine_connection._dbs.pop(alias, None)
+        self.connected.clear()
+        self.pid = os.getpid()
+
+
+connections = ConnectionManager()
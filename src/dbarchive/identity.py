@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Identity map module for reusing the instances restored in the process
+'''
+
+import threading
+from collections import OrderedDict
+
+
+def size_of(instance):
+    '''
+    returns the estimated bytes of the restored attributes of the instance.
+
+    The arrays are counted by their nbytes and the strings by their length.
+    The lazy binaries already restored are counted as well,
+    since their values are shared with the copies of the instance.
+    The other objects are not counted.
+    '''
+    lazies = instance.__dict__.get('_lazies') or {}
+    values = list(instance.__dict__.values())
+    values.extend(lazy.value for lazy in lazies.values() if lazy.loaded)
+    size = 0
+    for value in values:
+        nbytes = getattr(value, 'nbytes', None)
+        if nbytes is not None:
+            size += nbytes
+        elif isinstance(value, basestring):
+            size += len(value)
+    return size
+
+
+def copy_instance(instance):
+    '''
+    returns the shallow copy of the instance sharing the restored attributes.
+
+    The pending lazy binaries are shared as well,
+    so that a binary restored by one of the copies is not restored again by the others.
+    '''
+    clone = object.__new__(type(instance))
+    clone.__dict__.update(instance.__dict__)
+    for name in ('_lazies', '_digests'):
+        if name in clone.__dict__:
+            clone.__dict__[name] = dict(clone.__dict__[name])
+    return clone
+
+
+class IdentityMap(object):
+    '''
+    The in-process identity map of the restored instances keyed by the document id.
+
+    The instance already restored is returned as it is, or as a shallow copy if copy is True,
+    instead of querying the mongodb and restoring its binaries again.
+    If max_bytes is given, the least recently used instances are evicted
+    while the total size of their restored attributes exceeds it.
+    The numbers of the hits and misses are counted in stats().
+    '''
+    def __init__(self, max_bytes=None, copy=False):
+        self.max_bytes = max_bytes
+        self.copy = copy
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def __contains__(self, pk):
+        return pk in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, pk):
+        '''
+        returns the instance of the document id, or None if it is not restored yet.
+        '''
+        with self.lock:
+            instance = self.entries.pop(pk, None)
+            if instance is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[pk] = instance
+            self.resize(pk, instance)
+            self.evict()
+        return copy_instance(instance) if self.copy else instance
+
+    def put(self, pk, instance):
+        '''
+        register the instance restored, and returns the instance to be used by the caller.
+        '''
+        with self.lock:
+            self.discard(pk)
+            self.entries[pk] = instance
+            self.resize(pk, instance)
+            self.evict()
+        return copy_instance(instance) if self.copy else instance
+
+    def refresh(self, pk):
+        '''
+        measure the instance of the document id again after its binaries are restored,
+        and evict the least recently used instances if needed.
+        '''
+        with self.lock:
+            instance = self.entries.get(pk)
+            if instance is not None:
+                self.resize(pk, instance)
+                self.evict()
+
+    def invalidate(self, pk):
+        '''
+        remove the instance of the document id from the map.
+        '''
+        with self.lock:
+            self.discard(pk)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.bytes = 0
+
+    def stats(self):
+        '''
+        returns the dict of the cache statistics.
+        '''
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.bytes
+            }
+
+    def discard(self, pk):
+        if self.entries.pop(pk, None) is not None:
+            self.bytes -= self.sizes.pop(pk)
+
+    def resize(self, pk, instance):
+        size = size_of(instance)
+        self.bytes += size - self.sizes.get(pk, 0)
+        self.sizes[pk] = size
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        while len(self.entries) > 1 and self.bytes > self.max_bytes:
+            pk, _ = self.entries.popitem(last=False)
+            self.bytes -= self.sizes.pop(pk)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Instrumentation module for measuring the operations of the archiving and restoring
+'''
+
+import logging
+import threading
+import functools
+from copy import deepcopy
+from timeit import default_timer
+
+from pymongo import monitoring
+
+
+class NullRecord(object):
+    '''
+    The record returned while the instrumentation is disabled, which records nothing.
+
+    It is evaluated as False, so that the costly measurements can be skipped.
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def __nonzero__(self):
+        return False
+
+    __bool__ = __nonzero__
+
+    def __setattr__(self, name, value):
+        pass
+
+    def add(self, **counts):
+        pass
+
+
+null_record = NullRecord()
+
+
+class Record(object):
+    '''
+    The measurement of an operation on a class (target) and its attribute.
+
+    The wall time and the mongodb round trips are measured between enter and exit,
+    and the serialized bytes (bytes) and the bytes before the compression (raw_bytes)
+    are given by the operation itself.
+    '''
+    def __init__(self, instrumentation, operation, target=None, attribute=None):
+        self.instrumentation = instrumentation
+        self.operation = operation
+        self.target = target
+        self.attribute = attribute
+        self.time = 0.0
+        self.bytes = 0
+        self.raw_bytes = 0
+        self.round_trips = 0
+        self.error = None
+        self.start = None
+
+    def __enter__(self):
+        self.instrumentation.stack().append(self)
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.time = default_timer() - self.start
+        self.instrumentation.stack().remove(self)
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self.instrumentation.report(self)
+        return False
+
+    def add(self, **counts):
+        '''
+        add the counts to the record, e.g. add(bytes=1024).
+        '''
+        for name, count in counts.items():
+            setattr(self, name, getattr(self, name) + count)
+
+    def as_dict(self):
+        return {
+            'operation': self.operation,
+            'target': self.target,
+            'attribute': self.attribute,
+            'time': self.time,
+            'bytes': self.bytes,
+            'raw_bytes': self.raw_bytes,
+            'round_trips': self.round_trips,
+            'error': self.error
+        }
+
+
+def new_stats():
+    return {'count': 0, 'errors': 0, 'time': 0.0, 'bytes': 0, 'raw_bytes': 0, 'round_trips': 0}
+
+
+class Instrumentation(object):
+    '''
+    The instrumentation of the operations, which is disabled by default.
+
+    The records of the operations are accumulated per operation and per attribute,
+    which are returned by snapshot(), and passed to the hooks on their exit.
+    The mongodb commands issued in the thread of the operation are counted
+    as its round trips, including the ones of the nested operations.
+    While it is disabled, measure() returns the null record without any measurement.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.hooks = []
+        self.stats = {}
+        self.attributes = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def add_hook(self, hook):
+        '''
+        add the callable called with the Record on the exit of each operation.
+        '''
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def measure(self, operation, target=None, attribute=None):
+        '''
+        returns the record to measure the operation in the with statement.
+        '''
+        if not self.enabled:
+            return null_record
+        return Record(self, operation, target, attribute)
+
+    def current(self):
+        '''
+        returns the innermost record being measured in the thread, or the null record.
+        '''
+        if not self.enabled:
+            return null_record
+        stack = self.stack()
+        return stack[-1] if stack else null_record
+
+    def stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def round_trip(self):
+        '''
+        count a mongodb command for the records being measured in the thread.
+        '''
+        if not self.enabled:
+            return
+        for record in self.stack():
+            record.round_trips += 1
+
+    def report(self, record):
+        with self.lock:
+            stats = [self.stats.setdefault(record.operation, new_stats())]
+            if record.attribute is not None:
+                attributes = self.attributes.setdefault(record.operation, {})
+                stats.append(attributes.setdefault(record.attribute, new_stats()))
+            for entry in stats:
+                entry['count'] += 1
+                entry['errors'] += record.error is not None
+                entry['time'] += record.time
+                entry['bytes'] += record.bytes
+                entry['raw_bytes'] += record.raw_bytes
+                entry['round_trips'] += record.round_trips
+        for hook in list(self.hooks):
+            try:
+                hook(record)
+            except Exception:
+                logging.exception('the instrumentation hook failed: {}'.format(hook))
+
+    def snapshot(self):
+        '''
+        returns the dict of the accumulated stats per operation.
+
+        Each entry has the count, errors, time, bytes, raw_bytes, round_trips,
+        compression_ratio (raw_bytes / bytes) and the same stats per attribute.
+        '''
+        with self.lock:
+            snapshot = deepcopy(self.stats)
+            for operation, entry in snapshot.items():
+                entry['attributes'] = deepcopy(self.attributes.get(operation, {}))
+        for entry in snapshot.values():
+            for stats in [entry] + entry['attributes'].values():
+                stats['compression_ratio'] = (
+                    float(stats['raw_bytes']) / stats['bytes'] if stats['bytes'] else None)
+        return snapshot
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+            self.attributes.clear()
+
+
+instrumentation = Instrumentation()
+
+
+def instrumented(operation):
+    '''
+    the decorator measuring the method (or the classmethod) as the operation on its class.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not instrumentation.enabled:
+                return func(self, *args, **kwargs)
+            target = self.__name__ if isinstance(self, type) else type(self).__name__
+            with instrumentation.measure(operation, target):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class CommandCounter(monitoring.CommandListener):
+    '''
+    The pymongo command listener counting the round trips of the operations.
+    '''
+    def started(self, event):
+        instrumentation.round_trip()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# the listener is registered before any client is created by the connection manager.
+monitoring.register(CommandCounter())
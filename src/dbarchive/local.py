@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Local module for the embedded storage backend on the local file system
+'''
+
+import os
+import copy
+import shutil
+import sqlite3
+import tempfile
+import threading
+import cPickle as pickle
+
+import numpy
+from bson import ObjectId
+from mongoengine.errors import DoesNotExist
+from mongoengine.errors import MultipleObjectsReturned
+
+from base import Storage
+from base import LazyBinary
+from base import NpyArchiver
+from base import batched
+from base import projected
+from base import unprojected
+from base import ChunkedArray
+from base import describe_archiver
+from base import restoring_archiver
+from registry import archiver_name
+from pipeline import read_ahead
+
+# the number of the variables bound in a sqlite query at once
+query_size = 500
+
+missing = object()
+
+operators = {
+    'ne': lambda value, operand: value is missing or value != operand,
+    'lt': lambda value, operand: value is not missing and value < operand,
+    'lte': lambda value, operand: value is not missing and value <= operand,
+    'gt': lambda value, operand: value is not missing and value > operand,
+    'gte': lambda value, operand: value is not missing and value >= operand,
+    'in': lambda value, operand: value is not missing and value in operand,
+    'nin': lambda value, operand: value is missing or value not in operand,
+    'exists': lambda value, operand: (value is not missing) == bool(operand)
+}
+
+
+def parse_condition(key, operand):
+    '''
+    returns the (field, operator, operand) of the mongoengine style query keyword, e.g. base__lt=10.
+
+    The operands of pk / id are converted into ObjectId, as the strings are accepted by mongoengine.
+    '''
+    field, _, name = key.partition('__')
+    if name and name not in operators:
+        raise ValueError('unsupported query operator on LocalStorage: {}'.format(key))
+    if field in ('pk', 'id') and name != 'exists':
+        if name in ('in', 'nin'):
+            operand = [ObjectId(pk) for pk in operand]
+        else:
+            operand = ObjectId(operand)
+    return field, name or None, operand
+
+
+def matches(pk, natives, conditions):
+    '''
+    returns True if the document satisfies all the conditions.
+    '''
+    for field, name, operand in conditions:
+        value = pk if field in ('pk', 'id') else natives.get(field, missing)
+        if name is None:
+            if (None if value is missing else value) != operand:
+                return False
+        elif not operators[name](value, operand):
+            return False
+    return True
+
+
+class LocalDocument(object):
+    '''
+    The document of an instance on LocalStorage, which has the document id and the natives.
+
+    The natives are accessed as the attributes, as well as the mongoengine documents.
+    '''
+    def __init__(self, pk, natives=None):
+        self.pk = pk
+        self.id = pk
+        self.natives = dict(natives or {})
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['natives'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class LocalBinary(object):
+    '''
+    The binary entry of LocalStorage with the same attributes as LargeBinary for restoring.
+    '''
+    chunk_shape = None
+    segments = None
+
+    def __init__(self, row, path):
+        self.variable, self.archiver, self.archiver_version, self.codec, self.protocol, self.digest = row
+        self.path = path
+
+
+class MappedBinary(LazyBinary):
+    '''
+    The LazyBinary of LocalStorage restoring the npy files as the memmap.
+    '''
+    def __init__(self, binary, mode):
+        super(MappedBinary, self).__init__(binary)
+        self.mode = mode
+
+    def restore(self):
+        binary = self.binary
+        if binary.archiver == archiver_name(NpyArchiver) and not binary.codec:
+            try:
+                return numpy.load(binary.path, mmap_mode=self.mode)
+            except ValueError:
+                # the arrays of object dtype and the empty arrays cannot be memory-mapped
+                pass
+        with open(binary.path, 'rb') as fp:
+            return restoring_archiver(binary).restore(fp)
+
+
+class LocalQuerySet(object):
+    '''
+    The queryset of LocalStorage supporting the subset of the mongoengine queryset.
+
+    The documents of the class are filtered by the mongoengine style keywords
+    (exact, ne, lt, lte, gt, gte, in, nin and exists on the native attributes and pk),
+    ordered by order_by(), sliced by skip() / limit() or the slice,
+    and projected by only(), exclude() and exclude_binaries().
+    If natives is True, the documents are returned as LocalDocument without the binaries.
+    '''
+    def __init__(self, storage, clazz, natives=False):
+        self.storage = storage
+        self.clazz = clazz
+        self.natives = natives
+        self.conditions = []
+        self.ordering = []
+        self.offset = 0
+        self.count_limit = None
+        self.only_fields = None
+        self.excluded_fields = frozenset()
+
+    def clone(self):
+        queryset = copy.copy(self)
+        queryset.conditions = list(self.conditions)
+        queryset.ordering = list(self.ordering)
+        return queryset
+
+    def __call__(self, **query):
+        return self.filter(**query)
+
+    def all(self):
+        return self.clone()
+
+    def filter(self, **query):
+        queryset = self.clone()
+        queryset.conditions.extend(parse_condition(key, operand) for key, operand in query.items())
+        return queryset
+
+    def order_by(self, *keys):
+        queryset = self.clone()
+        queryset.ordering = list(keys)
+        return queryset
+
+    def skip(self, offset):
+        queryset = self.clone()
+        queryset.offset = offset
+        return queryset
+
+    def limit(self, count):
+        queryset = self.clone()
+        queryset.count_limit = count
+        return queryset
+
+    def only(self, *fields):
+        queryset = self.clone()
+        queryset.only_fields = frozenset(fields)
+        return queryset
+
+    def exclude(self, *fields):
+        queryset = self.clone()
+        queryset.excluded_fields = self.excluded_fields | frozenset(fields)
+        return queryset
+
+    def exclude_binaries(self, *names):
+        return self.exclude(*names)
+
+    def all_fields(self):
+        queryset = self.clone()
+        queryset.only_fields = None
+        queryset.excluded_fields = frozenset()
+        return queryset
+
+    def prefetch_binaries(self, batch_size=None, read=True):
+        # the binaries are read from the local files on restore
+        return self.clone()
+
+    def projection(self):
+        return self.only_fields, self.excluded_fields
+
+    def document_ids(self):
+        '''
+        returns the document ids the queryset is restricted to by pk / id conditions,
+        or None if it is not restricted.
+        '''
+        pks = None
+        for field, name, operand in self.conditions:
+            if field not in ('pk', 'id') or name not in (None, 'in'):
+                continue
+            candidates = set([operand] if name is None else operand)
+            pks = candidates if pks is None else pks & candidates
+        return pks
+
+    def documents(self):
+        '''
+        returns the list of (document id, natives) of the queryset.
+        '''
+        pks = self.document_ids()
+        if pks is not None and not pks:
+            return []
+        documents = [
+            (pk, natives) for pk, natives in self.storage.documents(self.clazz, pks)
+            if matches(pk, natives, self.conditions)
+        ]
+        for key in reversed(self.ordering):
+            field = key.lstrip('+-')
+            documents.sort(
+                key=lambda (pk, natives): pk if field in ('pk', 'id') else natives.get(field),
+                reverse=key.startswith('-'))
+        end = None if self.count_limit is None else self.offset + self.count_limit
+        return documents[self.offset:end]
+
+    def hydrate(self, documents):
+        '''
+        returns the class instances (or the LocalDocuments) of the documents.
+        '''
+        projection = self.projection()
+        results = []
+        for pk, natives in documents:
+            natives = dict(
+                (k, v) for k, v in natives.items() if projected(k, projection)
+            )
+            results.append(LocalDocument(pk, natives))
+        if self.natives:
+            return results
+
+        clazz = self.clazz
+        identity_map = clazz.identity_map
+        mapped = unprojected(projection)
+        pks = [document.pk for document in results if identity_map is None or document.pk not in identity_map]
+        binaries = self.storage.binaries(clazz, pks, projection)
+        instances = []
+        for document in results:
+            cached = identity_map.get(document.pk) if identity_map is not None else None
+            if cached is not None:
+                instances.append(cached)
+                continue
+            instances.append(clazz.assemble(
+                document, document.natives.items(), binaries.get(document.pk, []), mapped))
+        return instances
+
+    def __iter__(self):
+        return iter(self.hydrate(self.documents()))
+
+    def stream(self, batch_size=100, prefetch=1):
+        '''
+        yields the instances of the queryset, restoring the next prefetch batches in background.
+        '''
+        batches = (self.hydrate(documents) for documents in batched(self.documents(), batch_size))
+        for batch in read_ahead(batches, prefetch):
+            for instance in batch:
+                yield instance
+
+    def __getitem__(self, key):
+        documents = self.documents()
+        if isinstance(key, slice):
+            return self.hydrate(documents[key])
+        return self.hydrate([documents[key]])[0]
+
+    def count(self):
+        return len(self.documents())
+
+    def first(self):
+        documents = self.documents()
+        return self.hydrate(documents[:1])[0] if documents else None
+
+    def get(self, **query):
+        documents = self.filter(**query).documents()
+        if not documents:
+            raise DoesNotExist('{} matching query does not exist.'.format(self.clazz.__name__))
+        if len(documents) > 1:
+            raise MultipleObjectsReturned('{} items returned'.format(len(documents)))
+        return self.hydrate(documents)[0]
+
+    def delete_with_binaries(self, batch_size=1000):
+        '''
+        delete the documents of the queryset with their binaries, and returns the number of them.
+        '''
+        pks = [pk for pk, _ in self.documents()]
+        for batch in batched(pks, batch_size):
+            self.storage.delete(self.clazz, batch)
+        return len(pks)
+
+    def history(self, pk):
+        raise NotImplementedError('snapshot is supported only on MongoStorage')
+
+
+class LocalStorage(Storage):
+    '''
+    The Storage implementation on the local directory without the mongodb.
+
+    The natives of the instances are stored in the sqlite index file in the directory,
+    and each binary is stored in its own file, as the archiver output.
+    The npy files without codec are restored as the numpy.memmap of the file,
+    copy-on-write (mode='c') or read-only (mode='r').
+
+    The features specific to the mongodb, such as chunks, appends, deduplicate,
+    snapshots and the bulk APIs, are not supported and raise NotImplementedError,
+    and the binaries are always stored as a whole.
+    '''
+    def __init__(self, directory, mode='c'):
+        if mode not in ('r', 'c'):
+            raise ValueError("mode must be 'r' or 'c': {}".format(mode))
+        self.directory = directory
+        self.mode = mode
+        self.lock = threading.RLock()
+        self.connection = None
+        self.pid = None
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def database(self):
+        '''
+        returns the sqlite connection of the index, which is opened again in the forked process.
+        '''
+        if self.connection is None or self.pid != os.getpid():
+            connection = sqlite3.connect(
+                os.path.join(self.directory, 'index.sqlite'), check_same_thread=False)
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS documents '
+                    '(id TEXT PRIMARY KEY, collection TEXT NOT NULL, natives BLOB NOT NULL)')
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS documents_collection ON documents (collection)')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS binaries '
+                    '(parent TEXT, variable TEXT, archiver TEXT, archiver_version INTEGER, '
+                    'codec TEXT, protocol INTEGER, digest TEXT, PRIMARY KEY (parent, variable))')
+            self.connection = connection
+            self.pid = os.getpid()
+        return self.connection
+
+    def path(self, clazz, pk, variable=None):
+        path = os.path.join(self.directory, clazz.__name__, str(pk))
+        return path if variable is None else os.path.join(path, variable + '.bin')
+
+    def connect(self, clazz):
+        for feature in ('chunks', 'appends', 'deduplicate'):
+            if getattr(clazz, feature):
+                raise NotImplementedError(
+                    '{} of {} is supported only on MongoStorage'.format(feature, clazz.__name__))
+
+    def save(self, instance):
+        '''
+        save the instance, merging the natives into the stored ones,
+        so that the natives not loaded by only() / exclude() are kept.
+        '''
+        clazz = type(instance)
+        if clazz.identity_map is not None and instance.collection is not None:
+            clazz.identity_map.invalidate(instance.collection.pk)
+        natives, binaries = instance.split_attributes()
+        for k, v in binaries.items():
+            if isinstance(v, ChunkedArray):
+                raise NotImplementedError('ChunkedArray is supported only on MongoStorage: {}'.format(k))
+        if instance.collection is None:
+            instance.collection = LocalDocument(ObjectId())
+        document = instance.collection
+        stored = dict(self.documents(clazz, [document.pk])).get(document.pk, {})
+        merged = dict(stored)
+        merged.update(natives)
+        for k in binaries:
+            merged.pop(k, None)
+        written = [k for k, v in natives.items() if k not in stored or stored[k] != v]
+
+        rows = []
+        digests = instance.__dict__.setdefault('_digests', {})
+        for k, archiver, fp, digest in instance.dump_binaries(binaries):
+            self.write_file(self.path(clazz, document.pk, k), fp)
+            description = describe_archiver(archiver)
+            rows.append((
+                str(document.pk), k, description['archiver'], description['archiver_version'],
+                description['codec'], description['protocol'], digest
+            ))
+            digests[k] = digest
+            written.append(k)
+        # the binaries deleted or replaced by the natives since the last load / save.
+        # the binaries not restored yet are not included in binaries, but they are kept.
+        lazies = instance.__dict__.get('_lazies') or {}
+        removed = [k for k in digests if k not in binaries and k not in lazies]
+        for k in removed:
+            digests.pop(k)
+
+        data = sqlite3.Binary(pickle.dumps(merged, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            connection = self.database()
+            with connection:
+                updated = connection.execute(
+                    'UPDATE documents SET natives = ? WHERE id = ?', (data, str(document.pk)))
+                if updated.rowcount == 0:
+                    connection.execute(
+                        'INSERT INTO documents (id, collection, natives) VALUES (?, ?, ?)',
+                        (str(document.pk), clazz.__name__, data))
+                connection.executemany(
+                    'INSERT OR REPLACE INTO binaries '
+                    '(parent, variable, archiver, archiver_version, codec, protocol, digest) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                connection.executemany(
+                    'DELETE FROM binaries WHERE parent = ? AND variable = ?',
+                    [(str(document.pk), k) for k in removed])
+        for k in removed:
+            try:
+                os.remove(self.path(clazz, document.pk, k))
+            except OSError:
+                pass
+        document.natives.update(natives)
+        return sorted(written)
+
+    def write_file(self, path, fp):
+        '''
+        write the file stream into a temporary file and rename it into the path atomically.
+        '''
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                fp.seek(0)
+                shutil.copyfileobj(fp, out, 1 << 22)
+            os.rename(temp, path)
+        except:
+            os.remove(temp)
+            raise
+
+    def documents(self, clazz, pks=None):
+        '''
+        returns the list of (document id, natives) of the class in the insertion order,
+        or only of the document ids if pks is given.
+        '''
+        query = 'SELECT rowid, id, natives FROM documents WHERE collection = ?'
+        if pks is None:
+            batches = [[]]
+        else:
+            batches = list(batched([str(pk) for pk in pks], query_size))
+        rows = []
+        for batch in batches:
+            condition = ' AND id IN ({})'.format(', '.join('?' * len(batch))) if batch else ''
+            with self.lock:
+                rows.extend(self.database().execute(
+                    query + condition, [clazz.__name__] + batch).fetchall())
+        rows.sort()
+        return [(ObjectId(pk), pickle.loads(str(natives))) for _, pk, natives in rows]
+
+    def binaries(self, clazz, pks, projection=None):
+        '''
+        returns the dict of the document id to the list of MappedBinary in the projection.
+        '''
+        result = dict((pk, []) for pk in pks)
+        for batch in batched(pks, query_size):
+            with self.lock:
+                rows = self.database().execute(
+                    'SELECT parent, variable, archiver, archiver_version, codec, protocol, digest '
+                    'FROM binaries WHERE parent IN ({})'.format(', '.join('?' * len(batch))),
+                    [str(pk) for pk in batch]).fetchall()
+            for row in rows:
+                pk, variable = ObjectId(row[0]), row[1]
+                if projected(variable, projection):
+                    binary = LocalBinary(row[1:], self.path(clazz, pk, variable))
+                    result[pk].append(MappedBinary(binary, self.mode))
+        return result
+
+    def objects(self, clazz):
+        return LocalQuerySet(self, clazz)
+
+    def native_objects(self, clazz):
+        return LocalQuerySet(self, clazz, natives=True)
+
+    def delete(self, clazz, pks):
+        '''
+        delete the documents of the document ids with their binaries.
+        '''
+        ids = [str(pk) for pk in pks]
+        with self.lock:
+            connection = self.database()
+            with connection:
+                for batch in batched(ids, query_size):
+                    placeholders = ', '.join('?' * len(batch))
+                    connection.execute(
+                        'DELETE FROM binaries WHERE parent IN ({})'.format(placeholders), batch)
+                    connection.execute(
+                        'DELETE FROM documents WHERE id IN ({})'.format(placeholders), batch)
+        for pk in pks:
+            if clazz.identity_map is not None:
+                clazz.identity_map.invalidate(pk)
+            shutil.rmtree(self.path(clazz, pk), ignore_errors=True)
+
+    def drop(self, clazz, batch_size=1000):
+        if clazz.identity_map is not None:
+            clazz.identity_map.clear()
+        with self.lock:
+            connection = self.database()
+            with connection:
+                connection.execute(
+                    'DELETE FROM binaries WHERE parent IN '
+                    '(SELECT id FROM documents WHERE collection = ?)', (clazz.__name__, ))
+                connection.execute('DELETE FROM documents WHERE collection = ?', (clazz.__name__, ))
+        shutil.rmtree(os.path.join(self.directory, clazz.__name__), ignore_errors=True)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Pipeline module for running the binary serialization and transfer concurrently
+'''
+
+import sys
+import threading
+from collections import deque
+
+
+class Pipeline(object):
+    '''
+    The thread pool running the tasks concurrently with bounded in-flight bytes.
+
+    The tasks are started in the order of the items, and at most workers tasks
+    and max_bytes of their declared sizes are in flight at the same time.
+    A task larger than max_bytes is still started when no other task is in flight.
+
+    If some tasks fail, no more tasks are started and the error of the first
+    failing task in the item order is raised after all the started tasks finish.
+    The tasks are run serially in the calling thread if workers is 1.
+    '''
+    def __init__(self, workers=1, max_bytes=None):
+        self.workers = workers
+        self.max_bytes = max_bytes
+
+    def map(self, func, items, sizes=None):
+        '''
+        apply func to each item and returns the list of the results in the order of items.
+
+        sizes is the list of the estimated bytes held by each task.
+        '''
+        items = list(items)
+        if sizes is None:
+            sizes = [0] * len(items)
+        if self.workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+
+        results = [None] * len(items)
+        errors = {}
+        condition = threading.Condition()
+        state = {'tasks': 0, 'bytes': 0}
+
+        def run(index, item, size):
+            try:
+                results[index] = func(item)
+            except Exception:
+                with condition:
+                    errors[index] = sys.exc_info()
+            finally:
+                with condition:
+                    state['tasks'] -= 1
+                    state['bytes'] -= size
+                    condition.notify_all()
+
+        threads = []
+        for index, (item, size) in enumerate(zip(items, sizes)):
+            with condition:
+                while not errors and self.is_full(state, size):
+                    condition.wait()
+                if errors:
+                    break
+                state['tasks'] += 1
+                state['bytes'] += size
+            thread = threading.Thread(target=run, args=(index, item, size))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[min(errors)]
+            raise exc_type, exc_value, exc_traceback
+        return results
+
+    def is_full(self, state, size):
+        '''
+        returns True if the task of the size cannot be started now.
+        '''
+        if state['tasks'] >= self.workers:
+            return True
+        if self.max_bytes is None or state['tasks'] == 0:
+            return False
+        return state['bytes'] + size > self.max_bytes
+
+
+def read_ahead(iterable, depth=1):
+    '''
+    yields the items of the iterable, producing up to depth items ahead in a background thread.
+
+    The error raised by the iterable is raised in the consuming thread after the items before it.
+    The background thread stops after the item being produced when the generator is closed.
+    The items are produced in the calling thread if depth is 0.
+    '''
+    if depth <= 0:
+        for item in iterable:
+            yield item
+        return
+
+    buffer = deque()
+    condition = threading.Condition()
+    state = {'done': False, 'closed': False, 'error': None}
+
+    def produce():
+        try:
+            for item in iterable:
+                with condition:
+                    while len(buffer) >= depth and not state['closed']:
+                        condition.wait()
+                    if state['closed']:
+                        return
+                    buffer.append(item)
+                    condition.notify_all()
+        except Exception:
+            with condition:
+                state['error'] = sys.exc_info()
+        finally:
+            with condition:
+                state['done'] = True
+                condition.notify_all()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            with condition:
+                while not buffer and not state['done']:
+                    condition.wait()
+                if not buffer:
+                    break
+                item = buffer.popleft()
+                condition.notify_all()
+            yield item
+            # the consumed item is not referred from the generator any more
+            item = None
+        if state['error'] is not None:
+            exc_type, exc_value, exc_traceback = state['error']
+            raise exc_type, exc_value, exc_traceback
+    finally:
+        with condition:
+            state['closed'] = True
+            condition.notify_all()
+        thread.join()
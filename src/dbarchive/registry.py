@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Registry module for dispatching the archivers by the type of the variable
+'''
+
+import logging
+import threading
+
+entry_point_group = 'dbarchive.archivers'
+
+
+def archiver_name(archiver):
+    '''
+    returns the name of the archiver (instance or class) recorded on LargeBinary.
+    '''
+    clazz = archiver if isinstance(archiver, type) else archiver.__class__
+    return getattr(archiver, 'name', None) or clazz.__name__
+
+
+class ArchiverRegistry(object):
+    '''
+    The registry of the named, versioned archivers.
+
+    The archivers are registered once with the types they archive,
+    and the archiver of a variable is dispatched by the MRO of its type.
+    The dispatch result is cached per type until another archiver is registered.
+
+    The third-party packages can register their archivers by calling register(),
+    or by declaring the entry point of the 'dbarchive.archivers' group,
+    which is called with the registry on the first lookup.
+    '''
+    def __init__(self):
+        self.archivers = {}
+        self.types = {}
+        self.cache = {}
+        self.lock = threading.RLock()
+        self.entry_points_loaded = False
+
+    def register(self, archiver, types=(), name=None):
+        '''
+        register the archiver instance for the types.
+
+        The archiver is registered with its name and version attributes,
+        where the name defaults to the class name.
+        '''
+        with self.lock:
+            if name is not None:
+                archiver.name = name
+            name = archiver_name(archiver)
+            version = getattr(archiver, 'version', None)
+            self.archivers.setdefault(name, {})[version] = archiver
+            for clazz in types:
+                self.types[clazz] = archiver
+            self.cache.clear()
+        return archiver
+
+    def lookup(self, clazz):
+        '''
+        returns the archiver for the type, or None if no archiver is registered for its MRO.
+        '''
+        try:
+            return self.cache[clazz]
+        except KeyError:
+            pass
+        self.load_entry_points()
+        with self.lock:
+            archiver = None
+            for base in clazz.__mro__:
+                if base in self.types:
+                    archiver = self.types[base]
+                    break
+            self.cache[clazz] = archiver
+        return archiver
+
+    def get(self, name, version=None):
+        '''
+        returns the archiver of the name and version recorded on LargeBinary.
+
+        The latest version is returned if the version is None,
+        i.e. the binary is stored before the versions are recorded.
+        '''
+        self.load_entry_points()
+        versions = self.archivers.get(name)
+        if not versions:
+            raise ValueError('unknown archiver: {}'.format(name))
+        if version is None:
+            return versions[max(versions)]
+        if version not in versions:
+            raise ValueError('unknown version of the archiver {}: {}'.format(name, version))
+        return versions[version]
+
+    def load_entry_points(self):
+        if self.entry_points_loaded:
+            return
+        self.entry_points_loaded = True
+        try:
+            import pkg_resources
+        except ImportError:
+            return
+        for entry_point in pkg_resources.iter_entry_points(entry_point_group):
+            try:
+                entry_point.load()(self)
+            except Exception:
+                logging.exception('failed to load the archivers of {}'.format(entry_point))
+
+
+registry = ArchiverRegistry()
+
+
+def register_archiver(archiver, types=(), name=None):
+    '''
+    register the archiver instance for the types into the global registry.
+    '''
+    return registry.register(archiver, types, name)